@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+from matrix_client.api import MatrixRequestError
+from matrix_client.errors import MatrixHttpLibError
+
+import concurrent.futures
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from . import utils
+from .outbound import TokenBucket
+from .retry import get_retry_after, is_retryable
+
+USER_PENDING = "pending"
+USER_DONE = "done"
+USER_FAILED = "failed"
+
+
+class JobStore():
+    '''Durable record (SQLite) of the bulk membership jobs and of the state
+of each user of the job, so an interrupted job is resumed with only the
+users still pending.
+    '''
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            action TEXT NOT NULL,
+            room_id TEXT NOT NULL,
+            sender TEXT,
+            reply_room_id TEXT,
+            attempts INTEGER NOT NULL,
+            finished INTEGER NOT NULL DEFAULT 0,
+            created REAL NOT NULL)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS job_users (
+            job_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            state TEXT NOT NULL,
+            error TEXT,
+            PRIMARY KEY (job_id, user_id))''')
+
+    def add(self, job):
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.execute(
+                "INSERT INTO jobs (job_id, action, room_id, sender, "
+                "reply_room_id, attempts, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job.job_id, job.action, job.room_id, job.sender,
+                 job.reply_room_id, job.attempts, job.created))
+            self.db.executemany(
+                "INSERT INTO job_users (job_id, user_id, state) VALUES (?, ?, ?)",
+                [(job.job_id, user_id, USER_PENDING) for user_id in job.users])
+            self.db.execute("COMMIT")
+
+    def set_user_state(self, job_id, user_id, state, error=None):
+        with self.lock:
+            self.db.execute(
+                "UPDATE job_users SET state = ?, error = ? "
+                "WHERE job_id = ? AND user_id = ?",
+                (state, error, job_id, user_id))
+
+    def set_finished(self, job_id):
+        with self.lock:
+            self.db.execute("UPDATE jobs SET finished = 1 WHERE job_id = ?",
+                            (job_id,))
+
+    def get_unfinished(self):
+        '''Returns the unfinished jobs as (job fields, {user_id: (state,
+error)})'''
+        with self.lock:
+            jobs = self.db.execute(
+                "SELECT job_id, action, room_id, sender, reply_room_id, "
+                "attempts, created FROM jobs WHERE finished = 0 "
+                "ORDER BY created").fetchall()
+            res = []
+            for job in jobs:
+                users = self.db.execute(
+                    "SELECT user_id, state, error FROM job_users "
+                    "WHERE job_id = ? ORDER BY rowid", (job[0],)).fetchall()
+                res.append((job, dict((u, (s, e)) for u, s, e in users)))
+        return res
+
+    def purge(self, max_age):
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.execute(
+                "DELETE FROM job_users WHERE job_id IN (SELECT job_id FROM "
+                "jobs WHERE finished = 1 AND created < ?)",
+                (time.time() - max_age,))
+            self.db.execute(
+                "DELETE FROM jobs WHERE finished = 1 AND created < ?",
+                (time.time() - max_age,))
+            self.db.execute("COMMIT")
+
+
+class BulkJob():
+    def __init__(self, action, room_id, users, sender=None,
+                 reply_room_id=None, attempts=3, job_id=None, created=None):
+        self.job_id = job_id or uuid.uuid4().hex[:12]
+        self.action = action
+        self.room_id = room_id
+        self.users = list(users)
+        self.sender = sender
+        self.reply_room_id = reply_room_id
+        self.attempts = attempts
+        self.created = created or time.time()
+        self.states = dict((user_id, (USER_PENDING, None))
+                           for user_id in self.users)
+        self.finished = threading.Event()
+
+    def get_users(self, state):
+        return [u for u in self.users if self.states[u][0] == state]
+
+    def get_progress(self):
+        return "%s/%s (%s failed)" % (
+            len(self.users) - len(self.get_users(USER_PENDING)),
+            len(self.users),
+            len(self.get_users(USER_FAILED)))
+
+    def get_summary(self):
+        msg = "Action '%s' in room %s over %s users: %s done, %s failed" % (
+            self.action, self.room_id, len(self.users),
+            len(self.get_users(USER_DONE)), len(self.get_users(USER_FAILED)))
+        for user_id in self.get_users(USER_FAILED):
+            msg += "\n%s: %s" % (user_id, self.states[user_id][1])
+        return msg
+
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+
+class BulkMembershipExecutor():
+    '''Runs the invite/kick actions of a command over many users in the
+background. At most max_workers calls are in flight and they are paced by a
+token bucket (rate calls per second) that is paused when the homeserver
+answers with a rate limit. The users failing with a transient error are
+retried at the end of the job.
+
+The requester is notified with the progress every progress_interval seconds
+and with a summary (including the per-user failures) at the end. With a
+job store, the jobs interrupted by a restart are resumed by resume().
+
+call is called as call(action, attempts, room_id, user_id) and raises the
+Matrix errors. notify is called as notify(sender, message, reply_room_id).
+    '''
+    def __init__(self, call, notify, max_workers=4, rate=5, burst=10,
+                 progress_interval=30, max_requeues=2, store=None):
+        self.logger = utils.get_logger()
+        self.call = call
+        self.notify = notify
+        self.bucket = TokenBucket(rate, burst)
+        self.bucket_lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers)
+        self.progress_interval = progress_interval
+        self.max_requeues = max_requeues
+        self.store = store
+        self.jobs = {}
+        # Called as callback(job) when a job finishes, before wait() returns
+        self.on_finished = []
+
+    def submit(self, action, room_id, users, sender=None, reply_room_id=None,
+               attempts=3):
+        job = BulkJob(action, room_id, users, sender, reply_room_id, attempts)
+        if self.store:
+            self.store.add(job)
+        self._start(job)
+        return job
+
+    def resume(self):
+        '''Resumes the unfinished jobs of the store. Returns them'''
+        if not self.store:
+            return []
+        res = []
+        for fields, states in self.store.get_unfinished():
+            job_id, action, room_id, sender, reply_room_id, attempts, created = fields
+            job = BulkJob(action, room_id, list(states.keys()), sender,
+                          reply_room_id, attempts, job_id, created)
+            job.states.update(states)
+            self.logger.info("Resuming job %s: %s" % (job_id, job.get_progress()))
+            self._start(job)
+            res.append(job)
+        return res
+
+    def _start(self, job):
+        self.jobs[job.job_id] = job
+        threading.Thread(target=self._run, args=(job,),
+                         name="matrixbot-bulk-%s" % job.job_id,
+                         daemon=True).start()
+
+    def _acquire(self):
+        while True:
+            with self.bucket_lock:
+                wait = self.bucket.get_wait()
+                if not wait:
+                    self.bucket.take()
+                    return
+            time.sleep(wait)
+
+    def _pause(self, seconds):
+        with self.bucket_lock:
+            self.bucket.pause(seconds)
+
+    def _apply(self, job, user_id, last_try):
+        '''Returns True if the user must be retried later'''
+        try:
+            self.call(job.action, job.attempts, job.room_id, user_id)
+        except (MatrixRequestError, MatrixHttpLibError) as e:
+            retry_after = get_retry_after(e)
+            if retry_after:
+                self._pause(retry_after)
+            job.states[user_id] = (USER_FAILED, str(e))
+            if is_retryable(e) and not last_try:
+                return True  # Still pending in the store
+        else:
+            job.states[user_id] = (USER_DONE, None)
+        self._save_user_state(job, user_id)
+        return False
+
+    def _run(self, job):
+        try:
+            self._run_job(job)
+        except Exception as e:
+            self.logger.error("Error in job %s: %s" % (job.job_id, e))
+        finally:
+            for callback in self.on_finished:
+                try:
+                    callback(job)
+                except Exception as e:
+                    self.logger.error("Error in job %s: %s" % (job.job_id, e))
+            del self.jobs[job.job_id]
+            job.finished.set()
+
+    def _run_job(self, job):
+        self.logger.info("Job %s: %s in %s over %s users" % (
+            job.job_id, job.action, job.room_id, len(job.users)))
+        last_progress = time.time()
+        pending = job.get_users(USER_PENDING)
+        for requeue in range(self.max_requeues + 1):
+            last_try = requeue == self.max_requeues
+            futures = []
+            for user_id in pending:
+                self._acquire()
+                futures.append(self.executor.submit(self._apply, job, user_id,
+                                                    last_try))
+                last_progress = self._report_progress(job, last_progress)
+            not_done = futures
+            while not_done:
+                _, not_done = concurrent.futures.wait(
+                    not_done, timeout=self.progress_interval)
+                last_progress = self._report_progress(job, last_progress)
+            pending = [user_id for user_id, future in zip(pending, futures)
+                       if future.result()]
+            if not pending:
+                break
+            self.logger.info("Job %s: retrying %s users" % (job.job_id, len(pending)))
+        if self.store:
+            self.store.set_finished(job.job_id)
+        self.logger.info("Job %s finished: %s" % (job.job_id, job.get_progress()))
+        if job.sender:
+            self.notify(job.sender, job.get_summary(), job.reply_room_id)
+
+    def _save_user_state(self, job, user_id):
+        if not self.store:
+            return
+        state, error = job.states[user_id]
+        try:
+            self.store.set_user_state(job.job_id, user_id, state, error)
+        except sqlite3.Error as e:
+            self.logger.error("Error updating the job %s: %s" % (job.job_id, e))
+
+    def _report_progress(self, job, last_progress):
+        now = time.time()
+        if now - last_progress < self.progress_interval:
+            return last_progress
+        if job.sender:
+            self.notify(job.sender, "Action '%s' in room %s: %s" % (
+                job.action, job.room_id, job.get_progress()), job.reply_room_id)
+        return now
+
+    def get_jobs(self):
+        return list(self.jobs.values())
+
+    def wait(self, timeout=None):
+        '''Blocks until the running jobs finish. Returns False on timeout'''
+        deadline = time.time() + timeout if timeout is not None else None
+        for job in self.get_jobs():
+            wait = None
+            if deadline is not None:
+                wait = max(0, deadline - time.time())
+            if not job.wait(wait):
+                return False
+        return True
+
+
+def selftest():
+    print("selftest: " + os.path.basename(__file__))
+    test_requeue()
+    test_resume()
+
+
+def test_requeue():
+    print("test_requeue: ", end="")
+    calls = []
+
+    def call(action, attempts, room_id, user_id):
+        calls.append(user_id)
+        if user_id == "@b" and calls.count("@b") == 1:
+            raise MatrixRequestError(code=503, content="")
+        if user_id == "@c":
+            raise MatrixRequestError(code=403, content="Forbidden")
+    notified = []
+    bulk = BulkMembershipExecutor(
+        call, lambda *args: notified.append(args), rate=100, burst=100)
+    finished = []
+    bulk.on_finished.append(lambda job: finished.append(job.job_id))
+    job = bulk.submit("invite_user", "!a", ["@a", "@b", "@c"], "@sender")
+    assert(bulk.wait(10))
+    assert(job.get_users(USER_DONE) == ["@a", "@b"])
+    assert(job.get_users(USER_FAILED) == ["@c"])
+    # Only the transient errors are retried
+    assert(calls.count("@b") == 2 and calls.count("@c") == 1)
+    assert(len(notified) == 1 and "@c: 403" in notified[0][1])
+    assert(finished == [job.job_id])
+    print("Ok")
+
+
+def test_resume():
+    print("test_resume: ", end="")
+    import tempfile
+    with tempfile.TemporaryDirectory() as path:
+        store = JobStore(os.path.join(path, "jobs"))
+        job = BulkJob("kick_user", "!a", ["@a", "@b", "@c"])
+        store.add(job)
+        store.set_user_state(job.job_id, "@a", USER_DONE)
+        calls = []
+        bulk = BulkMembershipExecutor(
+            lambda action, attempts, room_id, user_id: calls.append(user_id),
+            None, rate=100, burst=100, store=store)
+        jobs = bulk.resume()
+        assert(bulk.wait(10))
+        assert(len(jobs) == 1 and jobs[0].job_id == job.job_id)
+        # Only the users still pending are processed
+        assert(sorted(calls) == ["@b", "@c"])
+        assert(jobs[0].get_users(USER_DONE) == ["@a", "@b", "@c"])
+        assert(store.get_unfinished() == [])
+        assert(bulk.resume() == [])
+    print("Ok")
+
+
+if __name__ == '__main__':
+    selftest()
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+import bisect
+import collections
+import hashlib
+import os
+import threading
+import time
+
+NEGATIVE = "__matrixbot_cache_negative__"  # Cached "not found" value
+ENTRY_VERSION = 1  # Format of the entries of TieredCache in the backend
+
+
+def get_namespace(key):
+    '''The namespace of "room_members-!room:domain" is
+"room_members"'''
+    return key.split("-", 1)[0]
+
+
+class LRUCache():
+    '''In-process cache bounded to max_items with a TTL per key'''
+    def __init__(self, max_items=1024):
+        self.max_items = max_items
+        self.items = collections.OrderedDict()  # key -> (expires, value)
+
+    def get(self, key, now=None):
+        '''Returns (found, value)'''
+        item = self.items.get(key)
+        if item is None:
+            return False, None
+        if item[0] < (now or time.time()):
+            del self.items[key]
+            return False, None
+        self.items.move_to_end(key)
+        return True, item[1]
+
+    def set(self, key, value, ttl, now=None):
+        self.items[key] = ((now or time.time()) + ttl, value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+    def delete(self, key):
+        self.items.pop(key, None)
+
+    def purge(self, match):
+        '''Removes the items whose match(key, value) is True'''
+        for key, item in list(self.items.items()):
+            if match(key, item[1]):
+                del self.items[key]
+
+
+class ConsistentHashRing():
+    '''Maps the keys to the nodes. Each node is placed in the ring
+replicas * weight times, so adding or removing a node only remaps the keys
+of that node'''
+    def __init__(self, nodes, replicas=100):
+        '''nodes: {node: weight}. Raises ValueError without nodes or with
+weights that are not positive'''
+        if not nodes:
+            raise ValueError("The hash ring needs at least one node")
+        self.points = []
+        self.nodes = []
+        for node, weight in sorted(nodes.items()):
+            if weight <= 0:
+                raise ValueError("Invalid weight %s of the node %s: it must "
+                                 "be positive" % (weight, node))
+            for i in range(max(1, int(replicas * weight))):
+                self.points.append(self._hash("%s-%s" % (node, i)))
+                self.nodes.append(node)
+        order = sorted(range(len(self.points)), key=lambda i: self.points[i])
+        self.points = [self.points[i] for i in order]
+        self.nodes = [self.nodes[i] for i in order]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:8], 16)
+
+    def get_node(self, key):
+        i = bisect.bisect(self.points, self._hash(key)) % len(self.points)
+        return self.nodes[i]
+
+
+class ShardedMemcache():
+    '''memcache.Client-like client spreading the keys over several
+memcached servers by consistent hashing. The reads of many keys are batched
+with one get_multi per server'''
+    def __init__(self, servers, create_client):
+        '''servers: {"ip:port": weight}. create_client(server) returns a
+memcache.Client for the server'''
+        self.clients = dict((server, create_client(server))
+                            for server in servers)
+        self.ring = ConsistentHashRing(servers)
+
+    def _get_client(self, key):
+        return self.clients[self.ring.get_node(key)]
+
+    def get(self, key):
+        return self._get_client(key).get(key)
+
+    def set(self, key, value, time=0):
+        return self._get_client(key).set(key, value, time)
+
+    def delete(self, key):
+        return self._get_client(key).delete(key)
+
+    def get_multi(self, keys):
+        by_server = collections.defaultdict(list)
+        for key in keys:
+            by_server[self.ring.get_node(key)].append(key)
+        res = {}
+        for server, server_keys in list(by_server.items()):
+            res.update(self.clients[server].get_multi(server_keys))
+        return res
+
+
+class TieredCache():
+    '''Cache with an in-process LRU tier in front of memcached (backend).
+
+The values found in memcached are kept in the LRU for up to local_ttl
+seconds so the hot keys do not pay the network round-trip and unpickling.
+Mind the values returned from the LRU are shared, do not modify them.
+
+The values are stored in memcached with their expiration time, as memcached
+does not tell it, so the LRU never keeps them longer than memcached does.
+
+get_or_fetch() caches the misses too (negative caching, for negative_ttl
+seconds) and, when concurrent threads miss the same key, only one of them
+calls fetch and the others wait for its result (single-flight).
+
+The hits and misses are counted per namespace (see get_namespace).
+    '''
+    def __init__(self, backend, max_items=1024, local_ttl=60, negative_ttl=30):
+        self.backend = backend
+        self.local = LRUCache(max_items)
+        self.local_ttl = local_ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.in_flight = {}  # key -> threading.Event
+        self.stats = {}
+
+    def _count(self, key, stat):
+        s = self.stats.setdefault(get_namespace(key), {
+            "local_hits": 0,
+            "backend_hits": 0,
+            "negative_hits": 0,
+            "misses": 0,
+            "fetches": 0,
+        })
+        s[stat] += 1
+
+    def _set_local(self, key, value, expires):
+        '''Keeps the value in the LRU for local_ttl (negative_ttl if it is a
+miss) but never after expires (0 means never)'''
+        ttl = self.negative_ttl if value == NEGATIVE else self.local_ttl
+        if expires:
+            ttl = min(ttl, expires - time.time())
+        if ttl > 0:
+            self.local.set(key, value, ttl)
+
+    def _set_backend_hit(self, key, entry):
+        '''Returns (found, value) of an entry of the backend (see set) and
+keeps the value in the LRU. The entries of other formats are ignored'''
+        if not isinstance(entry, tuple) or len(entry) != 3 or \
+                entry[0] != ENTRY_VERSION or \
+                (entry[1] and entry[1] <= time.time()):
+            self._count(key, "misses")
+            return False, None
+        expires, value = entry[1:]
+        self._count(key, "negative_hits" if value == NEGATIVE
+                    else "backend_hits")
+        self._set_local(key, value, expires)
+        return True, value
+
+    def _get(self, key):
+        '''Returns (found, value). value can be NEGATIVE'''
+        with self.lock:
+            found, value = self.local.get(key)
+            if found:
+                self._count(key, "negative_hits" if value == NEGATIVE
+                            else "local_hits")
+                return True, value
+        entry = self.backend.get(key)
+        with self.lock:
+            return self._set_backend_hit(key, entry)
+
+    def get(self, key):
+        found, value = self._get(key)
+        if not found or value == NEGATIVE:
+            return None
+        return value
+
+    def get_multi(self, keys):
+        '''Returns a dict with the values found. The keys not in the LRU
+are read from memcached in one batch'''
+        res = {}
+        pending = []
+        with self.lock:
+            for key in keys:
+                found, value = self.local.get(key)
+                if not found:
+                    pending.append(key)
+                    continue
+                self._count(key, "negative_hits" if value == NEGATIVE
+                            else "local_hits")
+                if value != NEGATIVE:
+                    res[key] = value
+        found = self.backend.get_multi(pending) if pending else {}
+        with self.lock:
+            for key in pending:
+                hit, value = self._set_backend_hit(key, found.get(key))
+                if hit and value != NEGATIVE:
+                    res[key] = value
+        return res
+
+    def set(self, key, value, ttl=0):
+        '''ttl in seconds. 0 means no expiration (as in memcached)'''
+        expires = time.time() + ttl if ttl else 0
+        with self.lock:
+            self._set_local(key, value, expires)
+        self.backend.set(key, (ENTRY_VERSION, expires, value), ttl)
+
+    def delete(self, key):
+        with self.lock:
+            self.local.delete(key)
+        self.backend.delete(key)
+
+    def get_or_fetch(self, key, fetch, ttl=0, cached=True):
+        '''Returns the cached value or the one returned by fetch(), which is
+cached. A None returned by fetch is cached as a miss for negative_ttl
+seconds. With cached=False the cached value is ignored and replaced'''
+        if cached:
+            found, value = self._get(key)
+            if found:
+                return None if value == NEGATIVE else value
+        with self.lock:
+            event = self.in_flight.get(key)
+            leader = event is None
+            if leader:
+                event = threading.Event()
+                self.in_flight[key] = event
+        if not leader:
+            event.wait()
+            return self.get(key)
+        try:
+            with self.lock:
+                self._count(key, "fetches")
+            value = fetch()
+            if value is None:
+                if self.negative_ttl:
+                    self.set(key, NEGATIVE, self.negative_ttl)
+            else:
+                self.set(key, value, ttl)
+            return value
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            event.set()
+
+    def get_stats(self):
+        '''Hits, misses and hit ratio of each namespace'''
+        with self.lock:
+            res = {}
+            for namespace, s in list(self.stats.items()):
+                s = dict(s)
+                lookups = s["local_hits"] + s["backend_hits"] + \
+                    s["negative_hits"] + s["misses"]
+                hits = lookups - s["misses"]
+                s["hit_ratio"] = float(hits) / lookups if lookups else 0
+                res[namespace] = s
+            return res
+
+
+def selftest():
+    print("selftest: " + os.path.basename(__file__))
+    test_lru()
+    test_single_flight()
+    test_negative()
+    test_backend_ttl()
+    test_hash_ring()
+
+
+class _TestBackend():
+    def __init__(self):
+        self.items = {}
+        self.gets = 0
+
+    def get(self, key):
+        self.gets += 1
+        return self.items.get(key)
+
+    def get_multi(self, keys):
+        self.gets += 1
+        return dict((k, self.items[k]) for k in keys if k in self.items)
+
+    def set(self, key, value, time=0):
+        self.items[key] = value
+
+    def delete(self, key):
+        self.items.pop(key, None)
+
+
+def test_lru():
+    print("test_lru: ", end="")
+    lru = LRUCache(2)
+    lru.set("a", 1, 10, now=100)
+    lru.set("b", 2, 10, now=100)
+    assert(lru.get("a", now=100) == (True, 1))
+    lru.set("c", 3, 10, now=100)  # "b" is the least recently used
+    assert(lru.get("b", now=100) == (False, None))
+    assert(lru.get("a", now=111) == (False, None))
+    print("Ok")
+
+
+def test_single_flight():
+    print("test_single_flight: ", end="")
+    cache = TieredCache(_TestBackend())
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        time.sleep(0.2)
+        return "value"
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(cache.get_or_fetch("ns-key", fetch, 60)))
+        for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert(len(fetches) == 1 and results == ["value"] * 8)
+    assert(cache.get_stats()["ns"]["fetches"] == 1)
+    print("Ok")
+
+
+def test_negative():
+    print("test_negative: ", end="")
+    backend = _TestBackend()
+    cache = TieredCache(backend, local_ttl=60, negative_ttl=1)
+    assert(cache.get_or_fetch("ns-none", lambda: None) is None)
+    assert(cache.get_or_fetch("ns-none", lambda: "found") is None)
+    # Another process sees the miss but keeps it only for negative_ttl
+    other = TieredCache(backend, local_ttl=60, negative_ttl=1)
+    assert(other.get("ns-none") is None)
+    assert(other.local.items["ns-none"][0] <= time.time() + 1)
+    assert(other.get_stats()["ns"]["negative_hits"] == 1)
+    print("Ok")
+
+
+def test_backend_ttl():
+    print("test_backend_ttl: ", end="")
+    backend = _TestBackend()
+    TieredCache(backend).set("ns-a", "a", 1)
+    TieredCache(backend).set("ns-b", "b")
+    backend.items["ns-old"] = "old format"
+    cache = TieredCache(backend, local_ttl=60)
+    assert(cache.get_multi(["ns-a", "ns-b", "ns-old"]) ==
+           {"ns-a": "a", "ns-b": "b"})
+    # The local copy expires with the memcached one
+    assert(cache.local.items["ns-a"][0] <= time.time() + 1)
+    assert(cache.local.items["ns-b"][0] > time.time() + 59)
+    print("Ok")
+
+
+def test_hash_ring():
+    print("test_hash_ring: ", end="")
+    keys = ["key-%s" % i for i in range(1000)]
+    ring = ConsistentHashRing({"s1": 1, "s2": 1, "s3": 1})
+    before = dict((k, ring.get_node(k)) for k in keys)
+    ring = ConsistentHashRing({"s1": 1, "s2": 1})
+    # Only the keys of the removed node are remapped
+    assert(all(ring.get_node(k) == node
+               for k, node in list(before.items()) if node != "s3"))
+    assert(ConsistentHashRing({"s1": 0.001}).get_node("key") == "s1")
+    for nodes in ({}, {"s1": 1, "s2": 0}, {"s1": -1}):
+        try:
+            ConsistentHashRing(nodes)
+            assert(False)
+        except ValueError:
+            pass
+    print("Ok")
+
+
+if __name__ == '__main__':
+    selftest()
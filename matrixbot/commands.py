@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+from . import utils
+
+
+class Command():
+    '''A message addressed to the bot, already tokenized and with the command
+aliases resolved.
+
+body: the text of the message ("bot: invite @user ...") with the bot name
+      added in the 1-to-1 rooms and the command alias resolved. New lines
+      and indentation are kept (e.g. for the broadcast plugin)
+name: the command name ("invite") or "" if there is not command
+args: the list of arguments after the command name
+
+The tokens are only used to route the command.
+    '''
+    def __init__(self, prefix, tokens, is_pm=False, in_reply_to=None,
+                 body=None):
+        self.prefix = prefix
+        self.tokens = tokens
+        self.name = tokens[0] if tokens else ""
+        self.args = tokens[1:]
+        self.body = body if body is not None else " ".join([prefix] + tokens)
+        self.is_pm = is_pm
+        self.in_reply_to = in_reply_to
+
+    def __str__(self):
+        return self.body
+
+
+class CommandRouter():
+    '''Tokenizes each message once, resolves the command aliases with a
+prebuilt dict and dispatches the command through a table of handlers. The
+plugins can register their own commands with register().
+
+A handler is called as handler(sender, room_id, command).
+    '''
+    def __init__(self, username, aliases=None):
+        self.logger = utils.get_logger()
+        self.username = username.lower()
+        self.mentions = ("%s:" % self.username, "%s " % self.username)
+        self.aliases = {}
+        for alias, command in list((aliases or {}).items()):
+            self.aliases[" ".join(alias.split())] = command.split()
+        self.handlers = {}
+        self.default_handler = None
+
+    def register(self, name, handler):
+        if name in self.handlers:
+            self.logger.warning("Command %s is already registered. Overriding it" % name)
+        self.handlers[name] = handler
+
+    def unregister(self, name):
+        self.handlers.pop(name, None)
+
+    def set_default_handler(self, handler):
+        '''Handler for the messages with the bot name but without command'''
+        self.default_handler = handler
+
+    def is_explicit_call(self, body):
+        return body.lstrip()[:len(self.username) + 1].lower().startswith(
+            self.mentions)
+
+    def parse(self, body, is_pm=False, in_reply_to=None):
+        '''Returns the Command in the message or None if the message is not
+addressed to the bot. In 1-to-1 rooms the bot name is optional.
+        '''
+        tokens = body.split()
+        if self.is_explicit_call(body):
+            prefix = tokens[0]
+            tokens = tokens[1:]
+        elif is_pm:
+            prefix = "%s:" % self.username
+            body = "%s %s" % (prefix, body)
+        else:
+            return None
+        alias = self.aliases.get(" ".join(tokens))
+        if alias is not None:
+            tokens = list(alias)
+            body = " ".join([prefix] + tokens)
+        return Command(prefix, tokens, is_pm, in_reply_to, body)
+
+    def get_handler(self, command):
+        if not command.name:
+            return self.default_handler
+        return self.handlers.get(command.name)
+
+    def dispatch(self, sender, room_id, command):
+        '''Returns False if there is not handler for the command'''
+        handler = self.get_handler(command)
+        self.logger.debug("Command %s (%s) handler: %s" % (command.name,
+                                                           command.body,
+                                                           handler))
+        if not handler:
+            return False
+        handler(sender, room_id, command)
+        return True
@@ -9,73 +9,219 @@
 
 
 import ldap as LDAP
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
+
+import concurrent.futures
+import contextlib
+import json
+import re
+import threading
+import time
 
 from . import utils
 
+RANGE_RE = re.compile(r";range=(\d+)-(\d+|\*)$", re.IGNORECASE)
+SNAPSHOT_VERSION = 1
+MAX_FILTER_UIDS = 100
 
-def get_custom_ldap_group_members(ldap_settings, group_name):
+
+def get_generalized_time(t):
+    return time.strftime("%Y%m%d%H%M%SZ", time.gmtime(t))
+
+
+def _connect(ldap_settings):
+    conn = LDAP.initialize(ldap_settings["server"])
+    timeout = ldap_settings.get("timeout")
+    if timeout:
+        conn.set_option(LDAP.OPT_NETWORK_TIMEOUT, timeout)
+        conn.set_option(LDAP.OPT_TIMEOUT, timeout)
+    if ldap_settings.get("bind_dn"):
+        conn.simple_bind_s(ldap_settings["bind_dn"],
+                           ldap_settings.get("bind_password", ""))
+    return conn
+
+
+def _paged_search(conn, ldap_settings, base, filterstr, attrlist=None,
+                  scope=LDAP.SCOPE_SUBTREE):
+    '''Yields the (dn, attrs) entries found page by page (Simple Paged
+Results control) so the big results are never in memory at once. The
+paging is disabled with a page_size of 0'''
+    page_size = ldap_settings.get("page_size", 500)
+    if not page_size:
+        for entry in conn.search_s(base, scope, filterstr, attrlist):
+            yield entry
+        return
+    control = SimplePagedResultsControl(True, size=page_size, cookie='')
+    while True:
+        msgid = conn.search_ext(base, scope, filterstr, attrlist,
+                                serverctrls=[control])
+        _, data, _, server_controls = conn.result3(msgid)
+        for entry in data:
+            if entry[0] is not None:  # Skipping the search references
+                yield entry
+        cookie = None
+        for c in server_controls:
+            if c.controlType == SimplePagedResultsControl.controlType:
+                cookie = c.cookie
+        if not cookie:
+            return
+        control.cookie = cookie
+
+
+def _iter_attr_values(conn, dn, attrs, attr):
+    '''Yields the values of the attribute of the entry. The very large
+attributes can be returned by the server in ranges (attr;range=0-1499) so the
+next ranges are requested until the last one (attr;range=N-*)'''
+    while True:
+        ranged = None
+        for key, values in list(attrs.items()):
+            if key.lower() == attr.lower():
+                for value in values:
+                    yield value
+                return
+            if key.lower().startswith(attr.lower() + ";range="):
+                ranged = key
+                for value in values:
+                    yield value
+        if ranged is None:
+            return
+        match = RANGE_RE.search(ranged)
+        if not match or match.group(2) == "*":
+            return
+        next_range = "%s;range=%d-*" % (attr, int(match.group(2)) + 1)
+        res = conn.search_s(dn, LDAP.SCOPE_BASE, "(objectClass=*)",
+                            [next_range])
+        if not res:
+            return
+        attrs = res[0][1]
+
+
+def _search_custom_group_members(conn, ldap_settings, group_name):
     logger = utils.get_logger()
-    ldap_server = ldap_settings["server"]
     ldap_base = ldap_settings["base"]
-    get_uid = lambda x: x[1]["uid"][0].decode("utf-8")
-    members = []
-    try:
-        conn = LDAP.initialize(ldap_server)
-        g_ldap_filter = ldap_settings[group_name]
-        logger.debug("Searching members for %s: %s" % (group_name,
-                                                       g_ldap_filter))
-        items = conn.search_s(ldap_base, LDAP.SCOPE_SUBTREE,
-                              attrlist=['uid'],
-                              filterstr=g_ldap_filter)
-        members = list(map(get_uid, items))
-    except Exception as e:
-        logger.error("Error getting custom group %s from LDAP: %s" % (group_name, e))
-    return members
+    g_ldap_filter = ldap_settings[group_name]
+    logger.debug("Searching members for %s: %s" % (group_name,
+                                                   g_ldap_filter))
+    for _, attrs in _paged_search(conn, ldap_settings, ldap_base,
+                                  g_ldap_filter, ['uid']):
+        if attrs.get("uid"):
+            yield attrs["uid"][0].decode("utf-8")
 
 
-def get_ldap_group_members(ldap_settings, group_name):
+def _search_group_members(conn, ldap_settings, group_name):
     # base:dc=example,dc=com
     # filter:(&(objectClass=posixGroup)(cn={group_name}))
     logger = utils.get_logger()
-    ldap_server = ldap_settings["server"]
     ldap_base = ldap_settings["groups_base"]
     ldap_filter = "(&%s(%s={group_name}))" % (ldap_settings["groups_filter"], ldap_settings["groups_id"])
+    member_attr = ldap_settings.get("groups_member_attr", "uniqueMember")
     get_uid = lambda x: x.decode("utf-8").split(",")[0].split("=")[1]
+    ad_filter = ldap_filter.replace('{group_name}', group_name)
+    logger.debug("Searching members for %s: %s - %s - %s" % (group_name,
+                                                             ldap_settings["server"],
+                                                             ldap_base,
+                                                             ad_filter))
+    for dn, attrs in _paged_search(conn, ldap_settings, ldap_base, ad_filter,
+                                   [member_attr]):
+        for value in _iter_attr_values(conn, dn, attrs, member_attr):
+            yield get_uid(value)
+        return  # Only the first group found, as before
+
+
+def _search_groups(conn, ldap_settings):
+    # filter:(objectClass=posixGroup)
+    # base:ou=Group,dc=example,dc=com
+    logger = utils.get_logger()
+    ldap_base = ldap_settings["groups_base"]
+    ldap_filter = ldap_settings["groups_filter"]
+    ldap_groups = ldap_settings["groups"]
+    groups_id = ldap_settings["groups_id"]
+    logger.debug("Searching groups: %s - %s - %s" % (ldap_settings["server"],
+                                                     ldap_base,
+                                                     ldap_filter))
+    res = []
+    for _, attrs in _paged_search(conn, ldap_settings, ldap_base, ldap_filter,
+                                  [groups_id]):
+        if not attrs.get(groups_id):
+            continue
+        name = attrs[groups_id][0].decode("utf-8")
+        if name in ldap_groups:
+            res.append(name)
+    return res
+
+
+def _search_modified_groups(conn, ldap_settings, since):
+    '''Returns the groups of the settings modified since the generalized
+time'''
+    ldap_base = ldap_settings["groups_base"]
+    ldap_filter = "(&%s(modifyTimestamp>=%s))" % (ldap_settings["groups_filter"], since)
+    ldap_groups = ldap_settings["groups"]
+    groups_id = ldap_settings["groups_id"]
+    res = []
+    for _, attrs in _paged_search(conn, ldap_settings, ldap_base, ldap_filter,
+                                  [groups_id]):
+        if not attrs.get(groups_id):
+            continue
+        name = attrs[groups_id][0].decode("utf-8")
+        if name in ldap_groups:
+            res.append(name)
+    return res
+
+
+def _search_modified_users(conn, ldap_settings, since):
+    '''Returns the uids of the users modified since the generalized time'''
+    ldap_filter = "(&(uid=*)(modifyTimestamp>=%s))" % since
+    return [attrs["uid"][0].decode("utf-8") for _, attrs in
+            _paged_search(conn, ldap_settings, ldap_settings["base"],
+                          ldap_filter, ['uid'])
+            if attrs.get("uid")]
+
+
+def _search_custom_group_subset(conn, ldap_settings, group_name, uids):
+    '''Returns which ones of the uids are members of the custom group'''
+    res = []
+    for i in range(0, len(uids), MAX_FILTER_UIDS):
+        uids_filter = "".join("(uid=%s)" % escape_filter_chars(uid)
+                              for uid in uids[i:i + MAX_FILTER_UIDS])
+        ldap_filter = "(&%s(|%s))" % (ldap_settings[group_name], uids_filter)
+        res += [attrs["uid"][0].decode("utf-8") for _, attrs in
+                _paged_search(conn, ldap_settings, ldap_settings["base"],
+                              ldap_filter, ['uid'])
+                if attrs.get("uid")]
+    return res
+
+
+def get_custom_ldap_group_members(ldap_settings, group_name):
+    logger = utils.get_logger()
     try:
-        ad_filter = ldap_filter.replace('{group_name}', group_name)
-        conn = LDAP.initialize(ldap_server)
-        logger.debug("Searching members for %s: %s - %s - %s" % (group_name,
-                                                                 ldap_server,
-                                                                 ldap_base,
-                                                                 ad_filter))
-        res = conn.search_s(ldap_base, LDAP.SCOPE_SUBTREE, ad_filter)
+        conn = _connect(ldap_settings)
+        return list(_search_custom_group_members(conn, ldap_settings, group_name))
     except Exception as e:
-        logger.error("Error getting group from LDAP: %s" % e)
+        logger.error("Error getting custom group %s from LDAP: %s" % (group_name, e))
+    return []
+
 
-    return list(map(get_uid, res[0][1]['uniqueMember']))
+def get_ldap_group_members(ldap_settings, group_name):
+    logger = utils.get_logger()
+    try:
+        conn = _connect(ldap_settings)
+        return list(_search_group_members(conn, ldap_settings, group_name))
+    except Exception as e:
+        logger.error("Error getting group from LDAP: %s" % e)
+    return []
 
 
 def get_ldap_groups(ldap_settings):
     '''Returns the a list of found LDAP groups filtered with the groups list in
 the settings
     '''
-    # filter:(objectClass=posixGroup)
-    # base:ou=Group,dc=example,dc=com
     logger = utils.get_logger()
-    ldap_server = ldap_settings["server"]
-    ldap_base = ldap_settings["groups_base"]
-    ldap_filter = ldap_settings["groups_filter"]
-    ldap_groups = ldap_settings["groups"]
-    get_uid = lambda x: x[1]["cn"][0].decode("utf-8")
     try:
-        conn = LDAP.initialize(ldap_server)
-        logger.debug("Searching groups: %s - %s - %s" % (ldap_server,
-                                                         ldap_base,
-                                                         ldap_filter))
-        res = conn.search_s(ldap_base, LDAP.SCOPE_SUBTREE, ldap_filter)
-        return list(filter((lambda x: x in ldap_groups), list(map(get_uid, res))))
+        conn = _connect(ldap_settings)
+        return _search_groups(conn, ldap_settings)
     except Exception as e:
-        logger.error("Error getting groups from LDAP: %s (%s)" % (e, ldap_server))
+        logger.error("Error getting groups from LDAP: %s (%s)" % (e, ldap_settings["server"]))
     return []
 
 
@@ -99,3 +245,308 @@ def get_ldap_groups_members(ldap_settings):
 
 def get_groups(ldap_settings):
     return ldap_settings["groups"]
+
+
+class LDAPConnectionPool():
+    '''Keeps up to size open LDAP connections. The connections that fail
+are discarded and replaced by new ones.
+    '''
+    def __init__(self, ldap_settings, size=2):
+        self.ldap_settings = ldap_settings
+        self.size = size
+        self.semaphore = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []
+
+    @contextlib.contextmanager
+    def connection(self):
+        self.semaphore.acquire()
+        conn = None
+        ok = False
+        try:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                conn = _connect(self.ldap_settings)
+            yield conn
+            ok = True
+        finally:
+            if ok:
+                with self.lock:
+                    self.idle.append(conn)
+            elif conn is not None:
+                try:
+                    conn.unbind_s()
+                except Exception:
+                    pass
+            self.semaphore.release()
+
+
+class LDAPDirectory():
+    '''Long-lived LDAP client keeping a snapshot of the members of the
+groups ({group: [uid, ...]}). The snapshot is served for ttl seconds; once
+expired it is still served (stale) while a background thread updates it.
+Only the first request, without snapshot yet, waits for LDAP.
+
+The snapshot is updated incrementally by poll(): only the groups (and the
+users, for the custom groups) with a modifyTimestamp newer than the last poll
+are read again. A full refresh is done every full_refresh_period seconds to
+catch what the timestamps can not tell (e.g. deleted users).
+
+The searches of the members of each group are spread over the connections
+of the pool. on_refresh callbacks are called after each update and, with a
+path, the snapshot is persisted there so the changes can be tracked across
+runs. Without autosave it is only persisted by save(), e.g. once the changes
+are processed, together with the metadata of the application.
+    '''
+    def __init__(self, ldap_settings, ttl=300, pool_size=2,
+                 full_refresh_period=86400, poll_overlap=60):
+        self.logger = utils.get_logger()
+        self.ldap_settings = ldap_settings
+        self.ttl = ttl
+        self.full_refresh_period = full_refresh_period
+        self.poll_overlap = poll_overlap  # Margin for the clocks skew
+        self.pool = LDAPConnectionPool(ldap_settings, pool_size)
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.refreshing = False
+        self.path = None
+        self.autosave = True
+        self.metadata = {}
+        self.snapshot = None
+        self.custom_groups = []
+        self.updated = 0
+        self.polled = 0
+        self.full_refreshed = 0
+        self.version = 0
+        self.on_refresh = []
+        self.stats = {
+            "refreshes": 0,
+            "polls": 0,
+            "errors": 0,
+            "duration": 0,
+            "stale_hits": 0,
+        }
+
+    def set_path(self, path, autosave=True):
+        '''Loads the snapshot persisted in path and, with autosave, keeps it
+updated'''
+        self.path = path
+        self.autosave = autosave
+        if not path:
+            return
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            self.logger.info("No LDAP snapshot loaded from %s: %s" % (path, e))
+            return
+        if data.get("version") != SNAPSHOT_VERSION:
+            self.logger.warning("Ignoring LDAP snapshot %s with a different version" % path)
+            return
+        with self.lock:
+            self.snapshot = data["groups"]
+            self.custom_groups = data["custom_groups"]
+            self.updated = data["updated"]
+            self.polled = data["polled"]
+            self.full_refreshed = data["full_refreshed"]
+            self.metadata = data.get("metadata", {})
+            self.version += 1
+
+    def get_state(self):
+        '''The current snapshot as it is persisted'''
+        with self.lock:
+            return {
+                "version": SNAPSHOT_VERSION,
+                "groups": self.snapshot,
+                "custom_groups": self.custom_groups,
+                "updated": self.updated,
+                "polled": self.polled,
+                "full_refreshed": self.full_refreshed,
+            }
+
+    def save(self, state=None, metadata=None):
+        '''Persists the state (see get_state, the current one by default)
+with the metadata of the application (the loaded one by default)'''
+        if not self.path:
+            return
+        state = dict(state or self.get_state())
+        if metadata is not None:
+            self.metadata = metadata
+        state["metadata"] = self.metadata
+        try:
+            utils.write_file_atomically(self.path, json.dumps(state))
+        except (IOError, OSError) as e:
+            self.logger.error("Error saving the LDAP snapshot: %s" % e)
+
+    def _search(self, func, *args):
+        with self.pool.connection() as conn:
+            return func(conn, self.ldap_settings, *args)
+
+    def _map_aliases(self, uids):
+        aliases = self.ldap_settings.get('users_aliases', {})
+        return [aliases.get(uid, uid) for uid in uids]
+
+    def _search_members(self, func, group_name):
+        '''The members are streamed from the paged results into the
+snapshot list, with the aliases already mapped'''
+        aliases = self.ldap_settings.get('users_aliases', {})
+        members = []
+        with self.pool.connection() as conn:
+            for uid in func(conn, self.ldap_settings, group_name):
+                members.append(aliases.get(uid, uid))
+        return members
+
+    def _fetch_groups(self, groups, custom_groups):
+        res = {}
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.pool.size) as executor:
+            futures = {}
+            for g in groups:
+                futures[g] = executor.submit(self._search_members,
+                                             _search_group_members, g)
+            for g in custom_groups:
+                futures[g] = executor.submit(self._search_members,
+                                             _search_custom_group_members, g)
+            for g, future in list(futures.items()):
+                res[g] = future.result()
+        return res
+
+    def _fetch(self):
+        groups = self._search(_search_groups)
+        # pending groups to get members. filters for those groups are
+        # explicitelly defined in the settings
+        custom_groups = [g for g in self.ldap_settings["groups"]
+                         if g not in groups]
+        return self._fetch_groups(groups, custom_groups), custom_groups
+
+    def _fetch_changes(self):
+        '''Returns the snapshot updated with the changes since the last
+poll'''
+        since = get_generalized_time(self.polled - self.poll_overlap)
+        snapshot = dict(self.snapshot)
+        groups = [g for g in self._search(_search_modified_groups, since)
+                  if g not in self.custom_groups]
+        snapshot.update(self._fetch_groups(groups, []))
+        if not self.custom_groups:
+            return snapshot
+        uids = self._search(_search_modified_users, since)
+        if not uids:
+            return snapshot
+        modified = set(self._map_aliases(uids))
+        for g in self.custom_groups:
+            members = set(self._map_aliases(self._search(
+                _search_custom_group_subset, g, uids)))
+            snapshot[g] = [u for u in snapshot.get(g, [])
+                           if u not in modified or u in members]
+            current = set(snapshot[g])
+            snapshot[g] += [u for u in members if u not in current]
+        return snapshot
+
+    def _set_snapshot(self, snapshot, started, full):
+        '''Returns the changes of each group: {group: {"added": [...],
+"removed": [...]}}'''
+        changes = {}
+        old_snapshot = self.snapshot or {}
+        for g in set(snapshot) | set(old_snapshot):
+            new = set(snapshot.get(g, []))
+            old = set(old_snapshot.get(g, []))
+            if new != old:
+                changes[g] = {"added": sorted(new - old),
+                              "removed": sorted(old - new)}
+        with self.lock:
+            self.snapshot = snapshot
+            self.updated = time.time()
+            self.polled = started
+            if full:
+                self.full_refreshed = started
+            self.version += 1
+            self.stats["refreshes" if full else "polls"] += 1
+            self.stats["duration"] = self.updated - started
+        if self.autosave:
+            self.save()
+        self.logger.info("LDAP directory %s: %s groups, %s changed in %.2fs" % (
+            "refreshed" if full else "polled", len(snapshot), len(changes),
+            time.time() - started))
+        for callback in self.on_refresh:
+            callback()
+        return changes
+
+    def refresh(self):
+        '''Reads again the members of all the groups and returns them. If
+there is already a refresh in progress it waits for it'''
+        started = time.time()
+        with self.refresh_lock:
+            if self.full_refreshed >= started:
+                return self.snapshot  # Refreshed while we were waiting
+            try:
+                snapshot, self.custom_groups = self._fetch()
+            except Exception:
+                self.stats["errors"] += 1
+                raise
+            self._set_snapshot(snapshot, started, True)
+        return snapshot
+
+    def poll(self):
+        '''Updates the snapshot with the changes since the last poll and
+returns them (see _set_snapshot). It returns None when it read all the
+groups (there was not a previous snapshot or full_refresh_period passed), so
+everything must be checked again'''
+        started = time.time()
+        with self.refresh_lock:
+            previous = self.snapshot
+            try:
+                if previous is None or \
+                        started - self.full_refreshed > self.full_refresh_period:
+                    snapshot, self.custom_groups = self._fetch()
+                    full = True
+                else:
+                    snapshot = self._fetch_changes()
+                    full = False
+            except Exception:
+                self.stats["errors"] += 1
+                raise
+            changes = self._set_snapshot(snapshot, started, full)
+        return None if full else changes
+
+    def refresh_async(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self._background_refresh,
+                         name="matrixbot-ldap-refresh",
+                         daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.poll()
+        except Exception as e:
+            self.logger.error("Error refreshing the LDAP directory: %s" % e)
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def get_groups_members(self):
+        with self.lock:
+            snapshot = self.snapshot
+            expired = time.time() - self.updated > self.ttl
+        if snapshot is None:
+            try:
+                return self.refresh()
+            except Exception as e:
+                self.logger.error("Error getting groups from LDAP: %s (%s)" % (
+                    e, self.ldap_settings["server"]))
+                return {}
+        if expired:
+            self.stats["stale_hits"] += 1
+            self.refresh_async()
+        return snapshot
+
+    def get_stats(self):
+        with self.lock:
+            res = dict(self.stats)
+            res["version"] = self.version
+            res["age"] = time.time() - self.updated if self.updated else None
+            res["groups"] = len(self.snapshot or {})
+        return res
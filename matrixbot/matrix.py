@@ -7,11 +7,16 @@
 # Contact: saavedra.pablo at gmail.com
 
 from matrix_client.api import MatrixRequestError
+from matrix_client.errors import MatrixHttpLibError
 from matrix_client.client import MatrixClient
-from matrix_client.room import Room
 
 import asyncio
+import concurrent.futures
+import json
+import logging
+import os
 # import pprint
+import threading
 import time
 import traceback
 import re
@@ -23,15 +28,37 @@ from email.mime.text import MIMEText
 
 from . import utils
 from . import ldap as bot_ldap
+from .bulk import BulkMembershipExecutor, JobStore, USER_FAILED
+from .cache import LRUCache
+from .commands import CommandRouter
+from .outbound import Outbox, OutboundQueue, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+from .retry import RetryPolicy, raise_rate_limits
+from .selection import SelectionEngine
+from .workers import RoomWorkerPool
+from .store import RoomStateStore, MembershipRecord, SyncCheckpoint, ACTIVE_MEMBERSHIPS, MEMBERSHIPS
 
 EXTRA_DEBUG = 5
 
+SYNC_STATE_EVENT_TYPES = [
+    "m.room.member",
+    "m.room.canonical_alias",
+    "m.room.name",
+    "m.room.power_levels",
+]
+SYNC_TIMELINE_EVENT_TYPES = [
+    "m.room.message",
+]
+
 class MatrixBotError(Exception):
     pass
 
 class MatrixBot():
-    def __init__(self, settings):
+    def __init__(self, settings, name="matrix-bot"):
+        '''name: the name of the process (e.g. the tool). It names the local
+storage files owned by the process'''
         self.sync_token = None
+        self.name = name
+        self.storage_locks = []
 
         self.logger = utils.get_logger()
         self.cache = utils.create_cache(settings)
@@ -55,6 +82,8 @@ class MatrixBot():
 
         self.subscriptions_room_ids = settings.get("subscriptions", {}).keys()
         self.revokations_rooms_ids = settings.get("revokations", {}).keys()
+        # The ids of the rooms of the settings, once joined by join_rooms
+        self.configured_room_ids = None
         self.allowed_join_rooms_ids = [x for x in list(settings["allowed-join"].keys()) if x != 'default']
         self.default_allowed_join_rooms = settings\
             .get("allowed-join", {})\
@@ -69,45 +98,231 @@ class MatrixBot():
             .get("list-rooms", {})\
             .get("visible_subset", [])
 
+        # The matrix_client API is synchronous so all the homeserver I/O done
+        # from the asyncio loop is offloaded to this bounded pool of threads
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=matrix.get("io_workers", 10))
+
         self.client = MatrixClient(self.uri)
-        self.token = self.client.login_with_password(username=self.username,
-                                                     password=self.password)
+        raise_rate_limits(self.client.api)
+        retry = matrix.get("retry", {})
+        self.retry_policy = RetryPolicy(
+            base_delay=retry.get("base_delay", 1),
+            max_delay=retry.get("max_delay", 30),
+            max_total_time=retry.get("max_total_time", 120))
+        outbound = matrix.get("outbound", {})
+        self.outbox = None
+        outbox_file = self.get_process_storage_file("outbox")
+        if outbox_file:
+            self.outbox = Outbox(outbox_file)
+        self.outbox_retention = outbound.get("retention", 86400)
+        self.outbound = OutboundQueue(
+            self._send_message_event,
+            rate=outbound.get("rate", 1),
+            burst=outbound.get("burst", 10),
+            room_rate=outbound.get("room_rate", 0.5),
+            room_burst=outbound.get("room_burst", 5),
+            coalesce_window=outbound.get("coalesce_window", 2),
+            max_coalesce=outbound.get("max_coalesce", 10),
+            outbox=self.outbox,
+            retry_base_delay=outbound.get("retry_base_delay", 2),
+            retry_max_delay=outbound.get("retry_max_delay", 300),
+            max_age=outbound.get("max_age", 3600))
+        self.credentials_file = utils.get_storage_file(
+            settings, "%s.credentials" % self.get_user_id())
+        self.token = self.login()
+        self.outbound.replay()
+
+        bulk = matrix.get("bulk", {})
+        jobs_file = self.get_process_storage_file("jobs")
+        self.bulk = BulkMembershipExecutor(
+            self._call_membership_api,
+            self.send_private_message,
+            max_workers=bulk.get("max_workers", 4),
+            rate=bulk.get("rate", 5),
+            burst=bulk.get("burst", 10),
+            progress_interval=bulk.get("progress_interval", 30),
+            store=JobStore(jobs_file) if jobs_file else None)
+        self.bulk.on_finished.append(self._on_bulk_job_finished)
+        self.jobs_retention = bulk.get("retention", 7 * 86400)
+
+        self.store = RoomStateStore(self.get_user_id())
+        self.store.lazy_load_members = matrix.get("lazy_load_members", True)
+        self.timeline_limit = matrix.get("timeline_limit", 50)
+        # alias -> room_id, shared by all the plugins
+        self.room_aliases = LRUCache(matrix.get("alias_cache_size", 1024))
+        self.room_aliases_lock = threading.Lock()
+        self.alias_cache_ttl = matrix.get("alias_cache_ttl", 3600)
+        self.store.on_canonical_alias.append(self._update_room_aliases)
+        self.sync_filter = None
+        self.checkpoint = SyncCheckpoint(
+            utils.get_storage_file(settings, "%s.sync" % self.get_user_id()))
+        self.sync_stats = {
+            "syncs": 0,
+            "sync_errors": 0,
+            "sync_duration": 0,
+            "dispatches": 0,
+            "dispatch_duration": 0,
+            "dispatch_wait": 0,
+            "lag": 0,
+            "max_lag": 0,
+        }
+        self.cleanup_period = matrix.get("cleanup_period", 3600)
+        self.plugins_dispatched_at = 0
+        self.event_workers = RoomWorkerPool(
+            self.process_event,
+            max_workers=matrix.get("event_workers", 10),
+            timeout=matrix.get("command_timeout", 300))
+
+        ldap_settings = settings.get("ldap", {})
+        self.directory = bot_ldap.LDAPDirectory(
+            ldap_settings,
+            ttl=ldap_settings.get("cache_ttl", 300),
+            pool_size=ldap_settings.get("pool_size", 2),
+            full_refresh_period=ldap_settings.get("full_refresh_period", 86400))
+        self.selection = SelectionEngine(
+            self._get_ldap_groups_members,
+            self.normalize_user_id,
+            ttl=ldap_settings.get("selection_cache_ttl", 60))
+        self.directory.on_refresh.append(self.selection.invalidate)
+
+        self.router = CommandRouter(self.username, utils.get_aliases(settings))
+        self._register_commands()
 
-        self.rooms = []
-        self.room_aliases = {}
         self.plugins = []
         for plugin in list(settings['plugins'].values()):
             mod = __import__(plugin['module'], fromlist=[plugin['class']])
             klass = getattr(mod, plugin['class'])
             self.plugins.append(klass(self, plugin['settings']))
 
-    def _get_selected_users(self, groups_users_list):
-        def _add_or_remove_user(users, username, append):
-            username = self.normalize_user_id(username)
-            if append and username not in users["in"]:
-                users["in"].append(username)
-            if not append and username not in users["out"]:
-                users["out"].append(username)
-
-        ldap_settings = self.settings["ldap"]
-        append = True
-        users = {
-            "in": [],
-            "out": []
+    def _register_commands(self):
+        router = self.router
+        router.register("invite", lambda s, r, c: self.do_command("invite_user", s, r, c.body))
+        router.register("kick", lambda s, r, c: self.do_command("kick_user", s, r, c.body))
+        router.register("join", lambda s, r, c: self.do_join(s, r, c.body))
+        router.register("count", lambda s, r, c: self.do_count(s, r, c.body))
+        router.register("list", lambda s, r, c: self.do_list(s, r, c.body))
+        router.register("list-rooms", lambda s, r, c: self.do_list_rooms(s, r))
+        router.register("list-groups", lambda s, r, c: self.do_list_groups(s, r))
+        router.register("forward-to-email", lambda s, r, c: self.do_forward_to_email(s, r, c.body, c.in_reply_to))
+        router.register("ldap-refresh", lambda s, r, c: self.do_ldap_refresh(s, r))
+        router.register("help", lambda s, r, c: self.do_help(s, r, c.body, c.is_pm))
+        router.set_default_handler(lambda s, r, c: self.do_help(s, r, c.body, c.is_pm))
+
+    def register_command(self, name, handler):
+        '''Used by the plugins to add their commands to the router. The
+handler is called as handler(sender, room_id, command) where command is a
+matrixbot.commands.Command'''
+        self.router.register(name, handler)
+
+    def get_process_storage_file(self, name):
+        '''Returns the path of a local storage file owned by this process:
+it is named after the process (so the tools never pick up the state of the
+running bot) and it is locked while the process runs. None if the storage is
+disabled or if the file is in use (e.g. by an overlapping run of the same
+tool)'''
+        path = utils.get_storage_file(
+            self.settings, "%s.%s.%s" % (self.get_user_id(), self.name, name))
+        if not path:
+            return None
+        lock = utils.lock_file("%s.lock" % path)
+        if lock is None:
+            self.logger.warning("%s is in use by other process. Running without it" % path)
+            return None
+        self.storage_locks.append(lock)
+        self._adopt_legacy_storage_file(name, path)
+        return path
+
+    def _adopt_legacy_storage_file(self, name, path):
+        '''Previous versions kept one <user_id>.<name> file shared by all
+the processes. The first process started after the upgrade takes it over, so
+the work left in it (pending messages, unfinished jobs) is not lost'''
+        legacy_path = utils.get_storage_file(
+            self.settings, "%s.%s" % (self.get_user_id(), name))
+        if not os.path.exists(legacy_path):
+            return
+        if os.path.exists(path):
+            self.logger.warning("Ignoring %s of a previous version: %s already exists" % (
+                legacy_path, path))
+            return
+        lock = utils.lock_file("%s.lock" % legacy_path)
+        if lock is None:
+            return  # Other process is taking it over
+        try:
+            if os.path.exists(legacy_path):
+                utils.rename_database(legacy_path, path)
+                self.logger.info("%s of a previous version moved to %s" % (
+                    legacy_path, path))
+        except OSError as e:
+            self.logger.warning("Ignoring %s of a previous version: %s" % (
+                legacy_path, e))
+        finally:
+            lock.close()
+
+    def load_credentials(self):
+        if not self.credentials_file:
+            return None
+        try:
+            with open(self.credentials_file) as f:
+                credentials = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            self.logger.debug("No cached credentials: %s" % e)
+            return None
+        if credentials.get("uri") != self.uri or \
+                credentials.get("user_id") != self.get_user_id():
+            return None
+        return credentials
+
+    def save_credentials(self, token):
+        if not self.credentials_file:
+            return
+        credentials = {
+            "uri": self.uri,
+            "user_id": self.client.user_id,
+            "access_token": token,
+            "device_id": self.client.device_id,
         }
-        for item in groups_users_list:
-            if item == ("but"):
-                append = False
-            elif item.startswith("+"):
-                group_name = item[1:]
-                groups_members = bot_ldap.get_ldap_groups_members(ldap_settings)
-                if group_name in list(groups_members.keys()):
-                    list([_add_or_remove_user(users, x, append) for x in groups_members[group_name]])
-            else:
-                _add_or_remove_user(users, item, append)
+        try:
+            utils.write_file_atomically(self.credentials_file,
+                                        json.dumps(credentials))
+        except (IOError, OSError) as e:
+            self.logger.warning("Error caching the credentials: %s" % e)
+
+    def login(self):
+        '''Reuses the cached access token if it is still valid. Otherwise it
+logs in with the password, reusing the cached device_id, so the short-lived
+tools do not create a new device in each run
+        '''
+        credentials = self.load_credentials()
+        device_id = None
+        if credentials:
+            device_id = credentials.get("device_id")
+            self.client.api.token = credentials["access_token"]
+            try:
+                whoami = self.call_api("whoami", 2, raise_errors=True)
+                if whoami.get("user_id") == credentials["user_id"]:
+                    self.client.token = credentials["access_token"]
+                    self.client.user_id = credentials["user_id"]
+                    self.client.device_id = device_id
+                    self.logger.info("Reusing the cached access token (device %s)" % device_id)
+                    return self.client.token
+            except MatrixRequestError as e:
+                self.logger.info("Cached access token is not valid: %s" % e)
+            self.client.api.token = None
+
+        token = self.retry_policy.call(
+            "login",
+            lambda: self.client.login(self.username, self.password,
+                                      sync=False, device_id=device_id),
+            3)
+        self.save_credentials(token)
+        return token
+
+    def _get_selected_users(self, groups_users_list):
+        return self.selection.select(groups_users_list)
 
-        selected_users = [x for x in users["in"] if x not in users["out"]]
-        return selected_users
+    def _get_ldap_groups_members(self):
+        return self.directory.get_groups_members()
 
     def normalize_user_id(self, user_id):
         if not user_id.startswith("@"):
@@ -133,35 +348,103 @@ class MatrixBot():
         return False
 
     def get_real_room_id(self, room_id):
-        if room_id.startswith("#"):
-            room_id = self.client.api.get_room_id(room_id)
-        return room_id
-
-    def get_room_members(self, room_id):
-        key = "get_room_members-%s" % room_id
-        res = self.cache.get(key)
-        if res:
-            self.logger.debug("get_room_members (cached): %s" % (key))
-            return res
-        res = self.call_api("get_room_members", 2, room_id)
-        self.cache.set(key, res, self.cache_timeout)
-        self.logger.debug("get_room_members (non cached): %s" % (key))
-        return res
-
-    def refresh_room_members(self, room_id):
-        key = "get_room_members-%s" % room_id
-        self.cache.delete(key)
-        self.logger.debug("refresh_room_members: %s" % (key))
+        '''Resolves the room aliases. The resolved aliases are cached for
+alias_cache_ttl seconds or until the room changes its canonical alias'''
+        if not room_id.startswith("#"):
+            return room_id
+        with self.room_aliases_lock:
+            found, real_room_id = self.room_aliases.get(room_id)
+        if found:
+            return real_room_id
+        real_room_id = self.call_api("get_room_id", 3, room_id,
+                                     raise_errors=True)
+        self._set_room_alias(room_id, real_room_id)
+        return real_room_id
+
+    def _set_room_alias(self, alias, room_id):
+        if not alias.startswith("#") or not room_id:
+            return
+        with self.room_aliases_lock:
+            self.room_aliases.set(alias, room_id, self.alias_cache_ttl)
+
+    def _update_room_aliases(self, room_id, event):
+        '''Called by the store with each m.room.canonical_alias event: the
+cached aliases of the room are dropped and the ones of the event (already
+validated by the homeserver) point to the room'''
+        content = event.get("content", {})
+        aliases = [content.get("alias")] + content.get("alt_aliases", [])
+        aliases = set(a for a in aliases if a)
+        with self.room_aliases_lock:
+            self.room_aliases.purge(
+                lambda alias, cached_room_id:
+                    cached_room_id == room_id or alias in aliases)
+            for alias in aliases:
+                self.room_aliases.set(alias, room_id, self.alias_cache_ttl)
+
+    def fetch_room_members(self, room_id, cached=True):
+        '''Returns the MembershipRecord of the room from the cache or from
+the /members endpoint'''
+        key = "room_members-%s" % room_id
+
+        def _fetch():
+            res = self.call_api("get_room_members", 2, room_id)
+            if res is None:
+                return None
+            return MembershipRecord.from_events(res.get('chunk', [])).dumps()
+
+        data = self.cache.get_or_fetch(key, _fetch, self.cache_timeout, cached)
+        if data is None:
+            return None
+        try:
+            return MembershipRecord.loads(data)
+        except ValueError as e:
+            self.logger.warning("Discarding cached %s: %s" % (key, e))
+            self.cache.delete(key)
+            return self.fetch_room_members(room_id, False) if cached else None
+
+    def prefetch_room_members(self, room_ids):
+        '''Reads in one batch (one get_multi per memcached server) the
+cached members of the rooms not followed by the sync, so the next
+fetch_room_members of these rooms are served from the local cache'''
+        keys = ["room_members-%s" % room_id for room_id in room_ids
+                if not self.store.has_room(room_id)]
+        if keys:
+            self.cache.get_multi(keys)
+
+    def _on_bulk_job_finished(self, job):
+        '''The membership of the rooms not followed by the sync is cached,
+so it is read again after changing it'''
+        if not self.store.has_room(job.room_id):
+            self.cache.delete("room_members-%s" % job.room_id)
+
+    def get_room_membership(self, room_id, complete=False):
+        '''Returns the membership of the room: a view of the store index or,
+for the rooms not followed by the sync (e.g. the tools do not sync), the
+cached MembershipRecord.
+
+complete: the whole list of members is needed, not only the lazy loaded
+ones'''
+        if self.store.has_room(room_id):
+            if complete and not self.store.members.is_complete(room_id):
+                res = self.call_api("get_room_members", 2, room_id)
+                if res:
+                    self.store.load_members(room_id, res.get('chunk', []))
+            return self.store.members.get_room(room_id)
+        record = self.fetch_room_members(room_id)
+        if record is None:
+            self.logger.debug("Error getting the members of the room %s" % room_id)
+            return MembershipRecord()
+        return record
+
+    def get_room_member_ids(self, room_id, memberships=ACTIVE_MEMBERSHIPS):
+        return self.get_room_membership(room_id, complete=True).get_members(
+            memberships)
 
     def is_room_member(self, room_id, user_id):
-        try:
-            r = Room(self.client, room_id)
-            room_members = [m.user_id for m in r.get_joined_members()]
-            return user_id in room_members
-        except Exception as e:
-            self.logger.error("Error when fetching room members: %s" % e)
-            return False
-        return False
+        members = self.get_room_membership(room_id)
+        if members.get_membership(user_id) is None:
+            members = self.get_room_membership(room_id, complete=True)
+        return members.is_joined(user_id)
 
     def check_send_mail_allowed(self, send_to):
         def _(f, if_, else_):
@@ -210,7 +493,8 @@ class MatrixBot():
                                 self.settings['mail']['port'])
         smtp.send_message(mail)
 
-    def do_command(self, action, sender, room_id, command, attempts=3):
+    def do_command(self, action, sender, room_id, command, attempts=3,
+                   candidates=None):
         """
         action  : The action to execute
         sender  : The sender of the message
@@ -219,6 +503,7 @@ class MatrixBot():
                   paramenter in the command
         command : Format: user: action [dryrun] #room:domain @user:domain [!group:domain] ...
         attempts: Maximum number of retries to execute the action
+        candidates: If passed, the action is only applied over these users
         """
         if sender:
             sender = self.normalize_user_id(sender)
@@ -259,15 +544,14 @@ class MatrixBot():
                                       room_id)
             return
 
-        room_members = set(map(lambda x: x['user_id'],
-                               self.get_room_members(target_room_id)["chunk"]))
+        room_members = self.get_room_member_ids(target_room_id)
 
         if action == "invite_user":
             selected_users = set(self._get_selected_users(command_arg_list)).difference(room_members)
-            self.refresh_room_members(target_room_id)
         if action == "kick_user":
             selected_users = set(self._get_selected_users(command_arg_list)).intersection(room_members)
-            self.refresh_room_members(target_room_id)
+        if candidates is not None:
+            selected_users = selected_users.intersection(candidates)
 
         if dry_mode and sender:
             self.send_private_message(
@@ -277,250 +561,358 @@ class MatrixBot():
                     target_room_id,
                     utils.list_to_str(selected_users)),
                 room_id)
-        else:
-            if len(selected_users) > 0:
-                for user in selected_users:
-                    self.logger.info(
-                        " do_command (%s,%s,%s,dry_mode=%s)" % (
-                            action,
-                            target_room_id,
-                            user,
-                            dry_mode))
-                    res = self.call_api(action, attempts, target_room_id, user)
-                if sender:
-                    msg = '''Action '%s' in room %s over %s''' % (
-                        action,
-                        target_room_id,
-                        utils.list_to_str(selected_users)
-                    )
-                    self.send_private_message(sender, msg, room_id)
-            elif sender:
-                self.send_private_message(sender,
-                                          "No users found",
-                                          room_id)
-
-    def invite_subscriptions(self):
-        for room_id in self.subscriptions_room_ids:
-            command = self.username.lower() + ": invite " + self.settings["subscriptions"][room_id]
-            self.do_command("invite_user", None, room_id, command, attempts=1)
-
-    def kick_revokations(self):
-        for room_id in self.revokations_rooms_ids:
-            command = self.username.lower() + ": kick " + self.settings["revokations"][room_id]
-            self.do_command("kick_user", None, room_id, command, attempts=1)
-
-    def call_api(self, action, max_attempts, *args):
-        method = getattr(self.client.api, action)
-        attempts = max_attempts
-        while attempts > 0:
-            try:
-                response = method(*args)
-                self.logger.info("Call %s action with: %s" % (action, args))
-                self.logger.debug("Call response: %s" % (response))
-                return response
-            except MatrixRequestError as e:
-                self.logger.debug("Fail (%s/%s) in call %s action with: %s - %s" % (attempts, max_attempts, action, args, e))
-                attempts -= 1
-                time.sleep(5)
-        return None
+        elif len(selected_users) > 0:
+            self.logger.info(
+                " do_command (%s,%s,%s users,dry_mode=%s)" % (
+                    action,
+                    target_room_id,
+                    len(selected_users),
+                    dry_mode))
+            job = self.bulk.submit(action, target_room_id,
+                                   sorted(selected_users), sender, room_id,
+                                   attempts)
+            if sender:
+                msg = '''Action '%s' in room %s over %s users started''' % (
+                    action,
+                    target_room_id,
+                    len(selected_users)
+                )
+                self.send_private_message(sender, msg, room_id)
+            return job
+        elif sender:
+            self.send_private_message(sender,
+                                      "No users found",
+                                      room_id)
 
-    def send_emote(self, room_id, message):
-        return self.call_api("send_emote", 3,
-                             room_id, message)
+    def _get_changed_users(self, expression, changes):
+        '''Returns the users added or removed from the groups of the
+expression according to the LDAP changes'''
+        res = set()
+        for group in self.selection.compile(expression.split()).get_groups():
+            group_changes = changes.get(group, {})
+            for user_id in group_changes.get("added", []) + group_changes.get("removed", []):
+                res.add(self.normalize_user_id(user_id))
+        return res
 
-    def send_html(self, room_id, message, msgtype="m.text"):
+    def _reconcile(self, action, rooms, changes=None, reconciled=None):
+        '''Runs the action in each room ({room_id: expression}) over the
+users selected by the expression. With the LDAP changes (LDAPDirectory.poll)
+only the users whose groups changed are considered, except in the rooms
+fully reconciled: the ones whose expression has no groups or is not the
+same of the last run (reconciled: {room_id: expression}). Returns True if
+the action was applied to every user without errors'''
+        word = "invite" if action == "invite_user" else "kick"
+        jobs = []
+        self.prefetch_room_members(list(rooms.keys()))
+        for room_id, expression in list(rooms.items()):
+            candidates = None
+            if changes is not None and \
+                    (reconciled or {}).get(room_id) == expression and \
+                    self.selection.compile(expression.split()).get_groups():
+                candidates = self._get_changed_users(expression, changes)
+                if not candidates:
+                    continue
+            command = self.username.lower() + ": " + word + " " + expression
+            job = self.do_command(action, None, room_id, command, attempts=1,
+                                  candidates=candidates)
+            if job:
+                jobs.append(job)
+        self.bulk.wait()
+        return not any(job.get_users(USER_FAILED) for job in jobs)
+
+    def get_subscriptions(self):
+        return dict((room_id, self.settings["subscriptions"][room_id])
+                    for room_id in self.subscriptions_room_ids)
+
+    def get_revokations(self):
+        return dict((room_id, self.settings["revokations"][room_id])
+                    for room_id in self.revokations_rooms_ids)
+
+    def invite_subscriptions(self, changes=None, reconciled=None):
+        '''See _reconcile'''
+        return self._reconcile("invite_user", self.get_subscriptions(),
+                               changes, reconciled)
+
+    def kick_revokations(self, changes=None, reconciled=None):
+        '''See _reconcile'''
+        return self._reconcile("kick_user", self.get_revokations(),
+                               changes, reconciled)
+
+    def _call_membership_api(self, action, attempts, room_id, user_id):
+        return self.call_api(action, attempts, room_id, user_id,
+                             raise_errors=True)
+
+    def call_api(self, action, max_attempts, *args, raise_errors=False):
+        '''Calls the client API method with the retry policy. It blocks
+while waiting for the retries so, from the asyncio loop, use acall_api'''
+        method = getattr(self.client.api, action)
+        try:
+            response = self.retry_policy.call(action, method, max_attempts,
+                                              *args)
+        except (MatrixRequestError, MatrixHttpLibError) as e:
+            self.logger.warning("Fail in call %s action with: %s - %s" % (action, args, e))
+            if raise_errors:
+                raise
+            return None
+        self.logger.info("Call %s action with: %s" % (action, args))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Call response: %s" % (response))
+        return response
+
+    async def acall_api(self, action, max_attempts, *args, raise_errors=False):
+        method = getattr(self.client.api, action)
+        try:
+            response = await self.retry_policy.acall(action, method,
+                                                     max_attempts, *args,
+                                                     executor=self.executor)
+        except (MatrixRequestError, MatrixHttpLibError) as e:
+            self.logger.warning("Fail in call %s action with: %s - %s" % (action, args, e))
+            if raise_errors:
+                raise
+            return None
+        self.logger.info("Call %s action with: %s" % (action, args))
+        return response
+
+    def get_api_stats(self):
+        '''Calls, retries, failures and latencies of each API action'''
+        return self.retry_policy.stats.get()
+
+    def send_emote(self, room_id, message, priority=PRIORITY_NORMAL):
+        content = {"msgtype": "m.emote", "body": message}
+        return self.outbound.put(room_id, content, priority)
+
+    def send_html(self, room_id, message, msgtype="m.text", priority=None):
         content = {
             "body": re.sub('<[^<]+?>', '', message),
             "msgtype": msgtype,
             "format": "org.matrix.custom.html",
             "formatted_body": message
         }
-        return self.client.api.send_message_event(
-            room_id, "m.room.message",
-            content
-        )
+        if priority is None:
+            priority = PRIORITY_LOW if msgtype == "m.notice" else PRIORITY_NORMAL
+        return self.outbound.put(room_id, content, priority)
+
+    def send_message(self, room_id, message, priority=PRIORITY_NORMAL):
+        content = {"msgtype": "m.text", "body": message}
+        return self.outbound.put(room_id, content, priority)
+
+    def send_notice(self, room_id, message, priority=PRIORITY_LOW):
+        content = {"msgtype": "m.notice", "body": message}
+        return self.outbound.put(room_id, content, priority)
 
-    def send_message(self, room_id, message):
-        return self.call_api("send_message", 3,
-                             room_id, message)
+    def _send_message_event(self, room_id, content, txn_id):
+        # The same txn_id in every retry, so the homeserver deduplicates
+        return self.call_api("send_message_event", 3,
+                             room_id, "m.room.message", content, txn_id,
+                             raise_errors=True)
 
-    def send_notice(self, room_id, message):
-        return self.call_api("send_notice", 3,
-                             room_id, message)
+    def get_outbound_stats(self):
+        return self.outbound.get_stats()
+
+    def close(self, timeout=None):
+        '''Waits for the bulk jobs and sends the queued messages. The tools
+must call it before exiting'''
+        self.bulk.wait(timeout)
+        return self.outbound.close(timeout)
 
     def send_private_message(self, user_id, message, room_id=None):
         # Just add a first case: if the channel is 1-to-1 then reply
         # directly using this channel
         if room_id and self.is_private_room(room_id, self.get_user_id(), user_id):
-            return self.call_api("send_message", 3, room_id, message)
+            return self.send_message(room_id, message, PRIORITY_HIGH)
 
         user_room_id = self.get_private_room_with(user_id)
         if room_id and room_id != user_room_id:
-            self.call_api(
-                "send_message",
-                3,
-                room_id,
-                "Replying command as PM to %s" % user_id)
-        return self.send_message(room_id, message)
+            self.send_message(room_id,
+                              "Replying command as PM to %s" % user_id,
+                              PRIORITY_HIGH)
+        return self.send_message(user_room_id, message, PRIORITY_HIGH)
 
     async def loop(self):
-        loop_pool = []
-        loop_max = 10
-        await self.sync(ignore=True)  # Ignoring pending old messages
+        if not self.restore_checkpoint():
+            await self.sync(ignore=True)  # Ignoring pending old messages
+            await self.save_checkpoint(self.sync_token)
+        # Only now the store (and the direct rooms index used to notify the
+        # requesters) is ready
+        await self.run_in_executor(self.bulk.resume)
+        asyncio.ensure_future(self.cleanup_loop())
+        self.directory.refresh_async()  # Warming up the LDAP snapshot
+        # The long-poll returns at least every 'period' seconds so the
+        # plugins (dispatched at most once per period, see _dispatch) are
+        # still dispatched with that frequency
+        timeout_ms = int(min(self.period, 30) * 1000)
+        dispatch_task = None
         while True:
             try:
-                loop_pool.append(asyncio.ensure_future(self.sync()))
-                await asyncio.sleep(self.period)
-                if loop_pool == loop_max:
-                    while len(loop_pool) > 0:
-                        task = loop_pool.pop()
-                        try:
-                            await task
-                        except asyncio.CancelledError as e:
-                            self.logger.error("matrixbot: Sync cancelled: %s" % e)
+                # Single-flight: only one sync is in flight and the next one
+                # starts as soon as the previous one returns. The dispatch of
+                # a response overlaps with the next long-poll but we never
+                # keep more than one dispatch pending (backpressure).
+                response = await self.fetch_sync(timeout_ms)
+                if not response:
+                    await asyncio.sleep(self.period)
+                    continue
+                if dispatch_task:
+                    waiting_since = time.time()
+                    await dispatch_task
+                    self.sync_stats["dispatch_wait"] = time.time() - waiting_since
+                dispatch_task = asyncio.ensure_future(
+                    self._timed_dispatch(response, time.time()))
             except Exception as e:
                 self.logger.error("matrixbot: Unexpected error: %s" % e)
-                self.logger.error("matrixbot: Unexpected error: %s" % traceback.print_exc())
+                self.logger.error("matrixbot: Unexpected error: %s" % traceback.format_exc())
+                await asyncio.sleep(self.period)
+
+    async def _timed_dispatch(self, response, received_at):
+        stats = self.sync_stats
+        started = time.time()
+        try:
+            await self._dispatch(response)
+            await self.save_checkpoint(response["next_batch"])
+        except Exception as e:
+            self.logger.error("matrixbot: Error in dispatch: %s" % e)
+        now = time.time()
+        stats["dispatches"] += 1
+        stats["dispatch_duration"] = now - started
+        stats["lag"] = now - received_at
+        stats["max_lag"] = max(stats["max_lag"], stats["lag"])
+        self.logger.debug("matrixbot: Sync stats: %s" % self.get_sync_stats())
+        self.logger.debug("matrixbot: API stats: %s" % self.get_api_stats())
+        self.logger.debug("matrixbot: Outbound stats: %s" % self.get_outbound_stats())
+        self.logger.debug("matrixbot: Cache stats: %s" % self.cache.get_stats())
+
+    def restore_checkpoint(self):
+        checkpoint = self.checkpoint.load()
+        if not checkpoint:
+            return False
+        self.sync_token, snapshot = checkpoint
+        self.store.restore(snapshot)
+        self.logger.info("Sync resumed from checkpoint: %s (%s rooms)" % (
+            self.sync_token, len(self.store.get_rooms())))
+        return True
+
+    async def save_checkpoint(self, next_batch):
+        if not next_batch:
+            return
+        try:
+            # The changes are taken here, in the loop thread which is the one
+            # updating the store. The serialization and the writes are
+            # offloaded
+            dumped = self.checkpoint.dump(next_batch, self.store)
+            await self.run_in_executor(self.checkpoint.save, dumped)
+        except Exception as e:
+            self.checkpoint.reset()
+            self.logger.error("Error saving the sync checkpoint: %s" % e)
+
+    def get_sync_stats(self):
+        return dict(self.sync_stats)
+
+    async def run_in_executor(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, func, *args)
+
+    async def cleanup_loop(self):
+        while True:
+            await asyncio.sleep(self.cleanup_period)
+            try:
+                await self.run_in_executor(self.leave_empty_rooms)
+            except Exception as e:
+                self.logger.error("matrixbot: Error in rooms cleanup: %s" % e)
+            if self.outbox:
+                try:
+                    await self.run_in_executor(self.outbox.purge,
+                                               self.outbox_retention)
+                except Exception as e:
+                    self.logger.error("matrixbot: Error in outbox cleanup: %s" % e)
+            if self.bulk.store:
+                try:
+                    await self.run_in_executor(self.bulk.store.purge,
+                                               self.jobs_retention)
+                except Exception as e:
+                    self.logger.error("matrixbot: Error in jobs cleanup: %s" % e)
 
     def leave_empty_rooms(self):
         self.logger.debug("leave_empty_rooms")
+        if self.configured_room_ids is None:
+            self.logger.debug("leave_empty_rooms: the rooms of the settings "
+                              "are not joined yet")
+            return
         rooms = self.get_rooms()
         for room_id in rooms:
-            res = self.get_room_members(room_id)
-            try:
-                members_list = res.get('chunk', [])
-            except Exception as e:
-                members_list = []
-                self.logger.debug("Error getting the list of members in room %s: %s" % (room_id, e))
-
-            if len(members_list) > 2:
-                continue  # We are looking for a 1-to-1 room
-
-            for r in res.get('chunk', []):
-                if 'user_id' in r and 'membership' in r:
-                    if r['membership'] == 'leave':
-                        self.call_api("kick_user", 1, room_id, self.get_user_id())
-                        try:
-                            self.call_api("forget_room", 1, room_id)
-                        except Exception as e:
-                            self.logger.warning("Some kind of error during the forget_room action: %s" % (e))
+            if room_id in self.configured_room_ids:
+                continue  # The rooms of the settings are never left
+            members = self.get_room_membership(room_id)
+            if members.count() > 1:
+                continue  # We are looking for a 1-to-1 room already abandoned
+            if not self.store.direct_rooms.is_direct_room(room_id):
+                members = self.get_room_membership(room_id, complete=True)
+                if len(members.get_members(MEMBERSHIPS)) > 2:
+                    continue  # We are looking for a 1-to-1 room
+
+            left = members.get_members(("leave",))
+            left.discard(self.get_user_id())
+            if len(left) > 0:
+                self.call_api("kick_user", 1, room_id, self.get_user_id())
+                try:
+                    self.call_api("forget_room", 1, room_id)
+                except Exception as e:
+                    self.logger.warning("Some kind of error during the forget_room action: %s" % (e))
 
     def get_private_room_with(self, user_id):
-        self.leave_empty_rooms()
         self.logger.debug("get_private_room_with")
-
-        rooms = self.get_rooms()
-        for room_id in rooms:
-            if self.is_private_room(room_id, self.get_user_id(), user_id):
-                return room_id
+        room_id = self.store.direct_rooms.get_direct_room(user_id)
+        if room_id:
+            return room_id
 
         # Not room found then ...
         room_id = self.call_api("create_room", 3,
-                                None, False,
-                                [user_id])['room_id']
+                                None, None, False,
+                                [user_id], raise_errors=True)['room_id']
+        with self.store.lock:
+            self.store.direct_rooms.set_direct_room(user_id, room_id)
+            content = self.store.direct_rooms.get_direct_account_data(user_id,
+                                                                      room_id)
         self.call_api(
-            "send_message",
-            3,
+            "set_account_data",
+            1,
+            self.get_user_id(),
+            "m.direct",
+            content
+        )
+        self.send_message(
             room_id,
-            "Hi! Get info about how to interact with me typing: %s help" % self.username
+            "Hi! Get info about how to interact with me typing: %s help" % self.username,
+            PRIORITY_HIGH
         )
         return room_id
 
     def is_private_room(self, room_id, user1_id, user2_id=None):
-        me = False  # me is true if the user1_id is in the room
-        him = False  # him is true if the user2_id join or is already
-
-        res = self.get_room_members(room_id)
-        try:
-            members_list = res.get('chunk', [])
-        except Exception as e:
-            members_list = []
-            self.logger.debug(
-                "Error getting the members of the room %s: %s" % (room_id, e))
-
-        if len(members_list) != 2:
-            self.logger.debug("Room %s is not a 1-to-1 room" % room_id)
-            return False  # We are looking for a 1-to-1 room
-
-        if not user2_id:
-            self.logger.debug("Room %s is a 1-to-1 with the user %s" % (room_id, user1_id))
-            return True  # I just check if the room is 1-to-1 for user1_id
-
-
-        # TODO: This code must be cleaned up
-        for r in res.get('chunk', []):
-            if (
-                'content' in r
-                and 'state_key' in r
-                and 'membership' in r['content']
-            ):
-                if r['state_key'] == user2_id and r['content']['membership'] == 'invite':
-                    him = True
-                if r['state_key'] == user2_id and r['content']['membership'] == 'join':
-                    him = True
-                if r['state_key'] == user1_id and r['content']['membership'] == 'join':
-                    me = True
-                if me and him:
-                    self.logger.debug(
-                        "A 1-to-1 room for %s and %s found: %s" % (
-                            user2_id,
-                            user1_id,
-                            room_id))
-                    return True
-
-        for r in res.get('chunk', []):
-            if (
-                'prev_content' in r
-                and 'state_key' in r['prev_content']
-                and 'membership' in r['prev_content']
-            ):
-                p = r['prev_content']
-                if p['state_key'] == user2_id and p['membership'] == 'invite':
-                    him = True
-                if p['state_key'] == user2_id and p['membership'] == 'join':
-                    him = True
-                if p['state_key'] == user1_id and p['membership'] == 'join':
-                    me = True
-                if me and him:
-                    self.logger.debug(
-                        "A 1-to-1 room for %s and %s found: %s" % (
-                            user2_id,
-                            user1_id,
-                            room_id))
-                    return True
-        return False
-
-    def is_explicit_call(self, body):
-        if (
-            body.lower().strip().startswith("%s:" % self.username.lower())
-            or body.lower().strip().startswith("%s " % self.username.lower())
+        members = self.get_room_membership(room_id)
+        if members.count() == 2 and (
+            members.get_membership(user1_id) is None or
+            (user2_id and members.get_membership(user2_id) is None)
         ):
-            return True
-        res = False
-        self.logger.debug("is_explicit_call: %s" % res)
+            members = self.get_room_membership(room_id, complete=True)
+        res = members.is_private_room(user1_id, user2_id)
+        self.logger.debug("Room %s is a 1-to-1 room for %s and %s: %s" % (
+            room_id, user1_id, user2_id, res))
         return res
 
-    def is_command(self, body, command="command_name"):
-        res = False
-        if self.is_explicit_call(body):
-            command_list = body.split()[1:]
-            if len(command_list) == 0:
-                if command == "help":
-                    res = True
-            else:
-                if command_list[0] == command:
-                    res = True
-        self.logger.debug("is_%s: %s" % (command, res))
-        return res
+    def is_explicit_call(self, body):
+        return self.router.is_explicit_call(body)
 
     def join_rooms(self, silent=True):
+        configured_room_ids = set()
         for room_id in self.room_ids:
             try:
-                room = self.client.join_room(room_id)
-                room_id = room.room_id  # Ensure we are using the actual id not the alias
+                room = self.call_api("join_room", 3, room_id,
+                                     raise_errors=True)
+                self._set_room_alias(room_id, room["room_id"])
+                room_id = room["room_id"]  # Ensure we are using the actual id not the alias
+                configured_room_ids.add(room_id)
                 if not silent:
                     self.send_message(room_id, "Mornings!")
-            except MatrixRequestError as e:
+            except (MatrixRequestError, MatrixHttpLibError) as e:
                 self.logger.error("Join action in room %s failed: %s" %
                                   (room_id, e))
 
@@ -529,11 +921,13 @@ class MatrixBot():
             try:
                 old_room_id = room_id
                 room_id = room_id + ':' + self.domain
-                room = self.client.join_room(room_id)
-                new_room_id = room.room_id  # Ensure we are using the actual id not the alias
+                room = self.call_api("join_room", 3, room_id,
+                                     raise_errors=True)
+                new_room_id = room["room_id"]  # Ensure we are using the actual id not the alias
+                self._set_room_alias(room_id, new_room_id)
                 new_subscriptions_room_ids.append(new_room_id)
                 self.settings["subscriptions"][new_room_id] = self.settings["subscriptions"][old_room_id]
-            except MatrixRequestError as e:
+            except (MatrixRequestError, MatrixHttpLibError) as e:
                 self.logger.error("Join action for subscribe users in room %s failed: %s" %
                                   (room_id, e))
         self.subscriptions_room_ids = new_subscriptions_room_ids
@@ -543,14 +937,18 @@ class MatrixBot():
             try:
                 old_room_id = room_id
                 room_id = room_id + ':' + self.domain
-                room = self.client.join_room(room_id)
-                new_room_id = room.room_id  # Ensure we are using the actual id not the alias
+                room = self.call_api("join_room", 3, room_id,
+                                     raise_errors=True)
+                new_room_id = room["room_id"]  # Ensure we are using the actual id not the alias
+                self._set_room_alias(room_id, new_room_id)
                 new_revokations_room_ids.append(new_room_id)
                 self.settings["revokations"][new_room_id] = self.settings["revokations"][old_room_id]
-            except MatrixRequestError as e:
+            except (MatrixRequestError, MatrixHttpLibError) as e:
                 self.logger.error("Join action for revoke users in room %s failed: %s" %
                                   (room_id, e))
         self.revokations_rooms_ids = new_revokations_room_ids
+        self.configured_room_ids = configured_room_ids.union(
+            self.subscriptions_room_ids, self.revokations_rooms_ids)
 
     def do_join(self, sender, room_id, body):
         self.logger.debug("do_join")
@@ -601,10 +999,8 @@ class MatrixBot():
         if (original_room_name in self.allowed_join_rooms_ids):
             allowed_users = self.settings["allowed-join"][original_room_name]
 
-        selected_users = self._get_selected_users(allowed_users.split())
-
-        self.logger.debug("Checking if %s is in %s" % (sender, selected_users))
-        if sender not in selected_users:
+        self.logger.debug("Checking if %s is selected by %s" % (sender, allowed_users))
+        if not self.selection.is_selected(allowed_users.split(), sender):
             msg = '''User %s can't join in room %s''' % (sender, original_room_id) + msg_dry_mode
             self.send_private_message(sender, msg, room_id)
             return
@@ -674,10 +1070,9 @@ class MatrixBot():
             if len(aliases) < 1:
                 self.logger.debug("Room %s hasn't got aliases. Skipping" % (r))
                 continue  # We are looking for rooms with alias
-            try:
-                name = self.client.api.get_room_name(r)['name']
-            except Exception as e:
-                self.logger.debug("Error getting the room name %s: %s" % (r, e))
+            name = self.get_room_name(r)
+            if not name:
+                self.logger.debug("Room %s hasn't got name" % (r))
                 name = "No named"
             if self.enable_list_rooms_commands:
                 is_visible_room = False
@@ -700,6 +1095,23 @@ class MatrixBot():
         except MatrixRequestError as e:
             self.logger.warning(e)
 
+    def do_ldap_refresh(self, sender, room_id):
+        self.logger.debug("do_ldap_refresh")
+        if sender not in self.super_users:
+            msg = "ldap-refresh is only allowed for super-users"
+            self.logger.warning("%s (%s)" % (msg, sender))
+            self.send_private_message(sender, msg, room_id)
+            return
+        try:
+            groups = self.directory.refresh()
+            stats = self.directory.get_stats()
+            msg = "LDAP directory refreshed: %s groups in %.2fs" % (
+                len(groups), stats["duration"])
+        except Exception as e:
+            msg = "Error refreshing the LDAP directory: %s" % e
+            self.logger.error(msg)
+        self.send_private_message(sender, msg, room_id)
+
     def do_list(self, sender, room_id, body):
         self.logger.debug("do_list")
         # TODO: This should be a decorator
@@ -757,6 +1169,7 @@ class MatrixBot():
 %(prefix)slist-rooms
 %(prefix)slist-groups
 %(prefix)sforward-to-email mailbox@example.domain (as reply for a message)
+%(prefix)sldap-refresh (only super-users)
 ''' % vars_
             if body.find("extra") >= 0:
                 msg_help += '''
@@ -818,11 +1231,12 @@ Available command aliases:
         end = False
         token = self.sync_token
         max_iters = 10
+        is_pm = self.is_private_room(room_id, self.get_user_id())
         for i in range(max_iters):
             r = self.call_api("get_room_messages", 1, room_id, token, "b", 500)
             for c in r["chunk"]:
-                command = self._get_command(room_id, c)
-                if self.is_command(command, "forward-to-email"):
+                command = self.parse_command(room_id, c, is_pm)
+                if command and command.name == "forward-to-email":
                     continue  # 'forward-to-email' are delivery skipped
                 if c.get("type", "") == "m.room.message":
                     c_in_reply_to = utils.get_in_reply_to(c)
@@ -869,36 +1283,25 @@ Thread forwarded from %s,
             traceback.print_exc()
 
         try:
-            self.send_message(room_id, msg)
+            self.send_message(room_id, msg, PRIORITY_HIGH)
         except MatrixRequestError as e:
             self.logger.warning(e)
 
     def _set_rooms(self, response_dict):
-        new_room_list = []
-        for rooms_types in list(response_dict['rooms'].keys()):
-            for room_id in list(response_dict['rooms'][rooms_types].keys()):
-                new_room_list.append(room_id)
-                self._set_room_aliases(room_id)
-        self.rooms = new_room_list
-
-    def _set_room_aliases(self, room_id):
-        room_dict_state = None
-        try:
-            aliases = []
-            room_dict_state = self.client.api.get_room_state(room_id)
-            for e in room_dict_state:
-                if e['type'] == 'm.room.canonical_alias':
-                    aliases = e['content']['alias']
-            self.room_aliases[room_id] = aliases
-        except Exception as e:
-            self.logger.log(EXTRA_DEBUG, "Error getting aliases for %s: %s" % (room_id, e))
-            self.logger.log(EXTRA_DEBUG, "Dict: %s" % (room_dict_state))
+        self.store.update(response_dict)
 
     def get_rooms(self):
-        return self.rooms
+        return self.store.get_rooms()
 
     def get_room_aliases(self, room_id):
-        return self.room_aliases[room_id] if room_id in self.room_aliases else []
+        alias = self.store.get_canonical_alias(room_id)
+        return alias if alias else []
+
+    def get_room_name(self, room_id):
+        return self.store.get_room_name(room_id)
+
+    def get_room_power_levels(self, room_id):
+        return self.store.get_power_levels(room_id)
 
     async def _dispatch(self, response):
         _tasks = []
@@ -908,14 +1311,19 @@ Thread forwarded from %s,
 
         async def _(plugin, callback):
             try:
-                plugin.dispatch(callback)
+                await self.run_in_executor(plugin.dispatch, callback)
             except Exception as e:
                 self.logger.error(
                     "Error in plugin %s: %s" % (plugin.name, e)
                 )
 
-        for plugin in self.plugins:
-            _tasks.append(asyncio.create_task(_(plugin, self.send_message)))
+        # The sync responses come as soon as there are new events but the
+        # plugins are dispatched once per period, as they were before
+        now = time.time()
+        if now - self.plugins_dispatched_at >= self.period:
+            self.plugins_dispatched_at = now
+            for plugin in self.plugins:
+                _tasks.append(asyncio.create_task(_(plugin, self.send_message)))
         _tasks.append(asyncio.ensure_future(
             self.sync_invitations(response['rooms'].get('invite', {}))))
         _tasks.append(asyncio.ensure_future(
@@ -923,16 +1331,101 @@ Thread forwarded from %s,
         for task in _tasks:
             await task
 
-    async def sync(self, ignore=False, timeout_ms=30000):
+    async def fetch_sync(self, timeout_ms=30000):
         response = None
+        started = time.time()
         try:
-            response = self.client.api.sync(self.sync_token, timeout_ms, full_state=True)
+            # Only the initial sync (no token yet) carries the full state of
+            # the rooms. After that we just ask for the deltas and merge them
+            # into the room state store.
+            if self.sync_filter is None:
+                self.sync_filter = await self.run_in_executor(
+                    self.create_sync_filter)
+            # Both the request and the decoding of the response run in the
+            # executor, out of the loop
+            response = await self.retry_policy.acall(
+                "sync", self.sync_request, 3,
+                self.sync_token, timeout_ms, self.sync_filter or None,
+                executor=self.executor)
             self._set_rooms(response)
             self.sync_token = response["next_batch"]
             self.logger.info("!!! sync_token: %s" % (self.sync_token))
-            self.logger.log(EXTRA_DEBUG, "Sync response: %s" % (response))
+            if self.logger.isEnabledFor(EXTRA_DEBUG):
+                self.logger.log(EXTRA_DEBUG, "Sync response: %s" % (response))
+            self.sync_stats["syncs"] += 1
         except Exception as e:
+            response = None
+            self.sync_stats["sync_errors"] += 1
             self.logger.error("Error in sync: %s" % e)
+        self.sync_stats["sync_duration"] = time.time() - started
+        return response
+
+    def sync_request(self, since=None, timeout_ms=30000, filter_id=None):
+        '''Same as client.api.sync() but the response is decoded with the
+fastest JSON backend available (utils.json_loads)'''
+        query_params = {"timeout": int(timeout_ms)}
+        if since:
+            query_params["since"] = since
+        if filter_id:
+            query_params["filter"] = filter_id
+        response = self.client.api._send("GET", "/sync",
+                                         query_params=query_params,
+                                         return_json=False)
+        started = time.time()
+        res = utils.json_loads(response.content)
+        self.logger.debug("Sync response decoded (%s): %d bytes in %.3fs" % (
+            utils.get_json_backend(), len(response.content),
+            time.time() - started))
+        return res
+
+    def get_sync_filter(self):
+        '''Only the events used by the bot (and the extra event types
+declared by the plugins with the event_types and state_event_types
+attributes) are requested in the sync'''
+        state_types = list(SYNC_STATE_EVENT_TYPES)
+        timeline_types = list(SYNC_TIMELINE_EVENT_TYPES)
+        for plugin in self.plugins:
+            for t in getattr(plugin, "state_event_types", []):
+                if t not in state_types:
+                    state_types.append(t)
+            for t in getattr(plugin, "event_types", []):
+                if t not in timeline_types:
+                    timeline_types.append(t)
+        for t in state_types:
+            if t not in timeline_types:
+                timeline_types.append(t)  # state changes come in the timeline
+        lazy_load_members = self.store.lazy_load_members
+        return {
+            "presence": {"not_types": ["*"]},
+            "account_data": {"types": ["m.direct"]},
+            "room": {
+                "state": {
+                    "types": state_types,
+                    "lazy_load_members": lazy_load_members,
+                },
+                "timeline": {
+                    "types": timeline_types,
+                    "limit": self.timeline_limit,
+                    "lazy_load_members": lazy_load_members,
+                },
+                "ephemeral": {"not_types": ["*"]},
+                "account_data": {"not_types": ["*"]},
+            },
+        }
+
+    def create_sync_filter(self):
+        try:
+            res = self.call_api("create_filter", 3, self.get_user_id(),
+                                self.get_sync_filter(), raise_errors=True)
+            self.logger.info("Sync filter created: %s" % res["filter_id"])
+            return res["filter_id"]
+        except Exception as e:
+            # An empty filter id means sync without filter
+            self.logger.warning("Error creating the sync filter: %s" % e)
+            return ""
+
+    async def sync(self, ignore=False, timeout_ms=30000):
+        response = await self.fetch_sync(timeout_ms)
         if not ignore:
             await self._dispatch(response)
 
@@ -948,38 +1441,51 @@ Thread forwarded from %s,
                         event["content"]["membership"] == 'invite' and \
                         "sender" in event and \
                         event["sender"].endswith(self.domain):
-                    _tasks.append(asyncio.create_task(
-                        self.call_api("join_room", 3, room_id)
+                    _tasks.append(asyncio.ensure_future(
+                        self.acall_api("join_room", 3, room_id)
                     ))
         for task in _tasks:
             await task
 
 
     async def sync_joins(self, join_events):
-        _tasks = []
+        # The events are processed in parallel across rooms and in order
+        # within each room. We wait for the whole batch so the checkpoint is
+        # only saved once its events are processed
+        _futures = []
         for room_id, sync_room in list(join_events.items()):
             self.logger.debug(">>> (join) %s" % (room_id))
             for event in sync_room["timeline"]["events"]:
-                _tasks.append(asyncio.ensure_future(
-                    self._process_event(room_id, event)
-                ))
-        for task in _tasks:
-            await task
-
-    def _get_command(self, room_id, event):
-        body = event["content"]["body"]
+                _futures.append(self.event_workers.submit(room_id, event))
+        for future in _futures:
+            await future
+        if _futures:
+            self.logger.debug("Event workers stats: %s" % (
+                self.event_workers.get_stats()))
+
+    def get_event_workers_stats(self):
+        '''Queue depth, processed events, errors, timeouts and latencies for
+each room'''
+        return self.event_workers.get_stats()
+
+    def parse_command(self, room_id, event, is_pm=None):
+        '''Returns the Command in a m.room.message event or None if it is not
+addressed to the bot'''
+        body = event.get("content", {}).get("body")
+        if not isinstance(body, str):
+            return None
         if utils.is_reply(event):
             body = "\n\n".join(body.split("\n\n")[1:])
 
-        is_pm = self.is_private_room(room_id, self.get_user_id())
-
-        if is_pm and not self.is_explicit_call(body):
-            body = "%s: " % self.username.lower() + body
+        if is_pm is None:
+            is_pm = self.store.direct_rooms.is_direct_room(room_id)
+        # Messages not mentioning the bot out of 1-to-1 rooms are rejected
+        # here, before any other work
+        if not is_pm and not self.router.is_explicit_call(body):
+            return None
+        return self.router.parse(body, is_pm, utils.get_in_reply_to(event))
 
-        body = utils.get_command_alias(body, self.settings)
-        return body
-
-    async def _process_event(self, room_id, event):
+    def process_event(self, room_id, event):
         if not (
             event["type"] == 'm.room.message'
             and "content" in event
@@ -988,41 +1494,20 @@ Thread forwarded from %s,
         ):
             return
 
+        sender = event["sender"]
+        if sender == self.get_user_id():
+            return
+
+        command = self.parse_command(room_id, event)
+        if not command:
+            return
+
         if self.commands_enable:
-            sender = event["sender"]
-            is_pm = self.is_private_room(room_id, self.get_user_id())
-            in_reply_to = utils.get_in_reply_to(event)
-            command = self._get_command(room_id, event)
-
-            if sender == self.get_user_id():
-                return
-
-            if not command.lower().strip().startswith("%s" % self.username):
-                return
-            if self.is_command(command, "invite"):
-                self.do_command("invite_user", sender, room_id, command)
-            elif self.is_command(command, "kick"):
-                self.do_command("kick_user", sender, room_id, command)
-            elif self.is_command(command, "join"):
-                self.do_join(sender, room_id, command)
-            elif self.is_command(command, "count"):
-                self.do_count(sender, room_id, command)
-            elif self.is_command(command, "list"):
-                self.do_list(sender, room_id, command)
-            elif self.is_command(command, "list-rooms"):
-                self.do_list_rooms(sender, room_id)
-            elif self.is_command(command, "list-groups"):
-                self.do_list_groups(sender, room_id)
-            elif self.is_command(command, "forward-to-email"):
-                self.do_forward_to_email(sender, room_id, command, in_reply_to)
-            elif self.is_command(command, "help"):
-                self.do_help(sender, room_id, command, is_pm)
-            elif len (command.split()[1:]) == 0 :
-                self.do_help(sender, room_id, command, is_pm)
+            self.router.dispatch(sender, room_id, command)
 
         # push to plugins
         for plugin in self.plugins:
             plugin.command(
-                sender, room_id, command,
+                sender, room_id, command.body,
                 self.send_message
             )
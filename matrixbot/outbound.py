@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+import collections
+import concurrent.futures
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from . import utils
+from .retry import is_retryable
+
+PRIORITY_HIGH = 0  # Replies to the commands
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2  # Notifications of the plugins
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+
+class TokenBucket():
+    '''rate tokens per second up to burst tokens'''
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_wait(self, now=None):
+        '''Seconds until there is a token available'''
+        now = now or time.time()
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now=None):
+        self._refill(now or time.time())
+        self.tokens -= 1
+
+    def pause(self, seconds, now=None):
+        '''No tokens available for the next seconds'''
+        self._refill(now or time.time())
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class Outbox():
+    '''Durable record (a SQLite database in WAL mode) of the outbound
+messages. Each message is stored with its transaction ID before being queued
+and it is marked as done when the homeserver accepts it, so the pending
+messages are replayed with the same transaction ID after a restart and the
+homeserver discards the duplicates.
+    '''
+    def __init__(self, path):
+        self.logger = utils.get_logger()
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.execute('''CREATE TABLE IF NOT EXISTS outbox (
+            txn_id TEXT PRIMARY KEY,
+            room_id TEXT NOT NULL,
+            content TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            created REAL NOT NULL,
+            updated REAL NOT NULL)''')
+        self.db.execute('''CREATE INDEX IF NOT EXISTS outbox_state
+            ON outbox (state, created)''')
+
+    def add(self, txn_id, room_id, content, priority):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO outbox (txn_id, room_id, content, priority, "
+                "created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (txn_id, room_id, json.dumps(content), priority, now, now))
+
+    def update_content(self, txn_id, content):
+        with self.lock:
+            self.db.execute(
+                "UPDATE outbox SET content = ?, updated = ? WHERE txn_id = ?",
+                (json.dumps(content), time.time(), txn_id))
+
+    def set_state(self, txn_id, state):
+        with self.lock:
+            self.db.execute(
+                "UPDATE outbox SET state = ?, updated = ? WHERE txn_id = ?",
+                (state, time.time(), txn_id))
+
+    def get_pending(self):
+        '''Returns the pending messages as (txn_id, room_id, content,
+priority, created) in the order they were queued'''
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT txn_id, room_id, content, priority, created FROM outbox "
+                "WHERE state = 'pending' ORDER BY created").fetchall()
+        return [(txn_id, room_id, json.loads(content), priority, created)
+                for txn_id, room_id, content, priority, created in rows]
+
+    def purge(self, max_age):
+        '''Removes the messages already done or failed before max_age
+seconds ago and the ones queued before max_age seconds ago and still
+pending (max_age must be longer than the max_age of the queue)'''
+        limit = time.time() - max_age
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM outbox WHERE (state != 'pending' AND updated < ?) "
+                "OR (state = 'pending' AND created < ?)", (limit, limit))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class OutboundMessage():
+    def __init__(self, room_id, content, priority, ready_at, txn_id=None,
+                 created=None):
+        self.room_id = room_id
+        self.content = content
+        self.priority = priority
+        self.ready_at = ready_at
+        self.created = created or ready_at
+        self.txn_id = txn_id or "mb%s" % uuid.uuid4().hex
+        self.merged = 1
+        self.attempts = 0
+        self.future = concurrent.futures.Future()
+
+    def can_merge(self, content):
+        return self.content.get("msgtype") == content.get("msgtype") and \
+            self.content.get("format") == content.get("format")
+
+    def merge(self, content):
+        self.content["body"] += "\n" + content["body"]
+        if "formatted_body" in self.content:
+            self.content["formatted_body"] += "<br/>" + content["formatted_body"]
+        self.merged += 1
+
+
+class OutboundQueue():
+    '''Sends the messages of the bot from a background thread respecting a
+token bucket for the whole account and another one for each room. The
+messages are sent by priority (the replies to the commands go ahead of the
+notifications of the plugins) and in order within the same room and
+priority.
+
+The low priority messages wait coalesce_window seconds before being sent
+and, meanwhile, the next ones for the same room are merged into them (up to
+max_coalesce messages).
+
+Each message has a transaction ID that is kept across the retries. The
+messages failing with a transient error are queued again with an exponential
+backoff (retry_base_delay up to retry_max_delay seconds), ahead of the next
+messages of the same room, until they are max_age seconds old. With an
+outbox the messages are persisted too and, after a restart, replay() queues
+again the ones not sent (and not older than max_age) with their original
+transaction ID.
+
+send is called as send(room_id, content, txn_id), returns the API response
+and raises the Matrix errors.
+    '''
+    def __init__(self, send, rate=1, burst=10, room_rate=0.5, room_burst=5,
+                 coalesce_window=2, max_coalesce=10, outbox=None,
+                 retry_base_delay=2, retry_max_delay=300, max_age=3600):
+        self.logger = utils.get_logger()
+        self.send = send
+        self.outbox = outbox
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.max_age = max_age
+        self.bucket = TokenBucket(rate, burst)
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.room_buckets = {}
+        self.coalesce_window = coalesce_window
+        self.max_coalesce = max_coalesce
+        self.lanes = dict((p, collections.deque()) for p in PRIORITIES)
+        self.coalescing = {}  # room_id -> pending low priority message
+        self.condition = threading.Condition()
+        self.thread = None
+        self.sending = 0
+        self.closing = False
+        self.stopped = False
+        self.stats = {
+            "queued": 0,
+            "sent": 0,
+            "merged": 0,
+            "requeued": 0,
+            "failures": 0,
+            "latency": 0,
+            "max_latency": 0,
+        }
+
+    def _get_room_bucket(self, room_id):
+        bucket = self.room_buckets.get(room_id)
+        if bucket is None:
+            bucket = TokenBucket(self.room_rate, self.room_burst)
+            self.room_buckets[room_id] = bucket
+        return bucket
+
+    def put(self, room_id, content, priority=PRIORITY_NORMAL):
+        '''Queues the message and returns a concurrent.futures.Future with
+the API response'''
+        now = time.time()
+        with self.condition:
+            if priority == PRIORITY_LOW and self.coalesce_window:
+                pending = self.coalescing.get(room_id)
+                if pending and pending.can_merge(content) \
+                        and pending.merged < self.max_coalesce:
+                    pending.merge(content)
+                    if self.outbox:
+                        self.outbox.update_content(pending.txn_id,
+                                                   pending.content)
+                    self.stats["merged"] += 1
+                    return pending.future
+                message = OutboundMessage(room_id, dict(content), priority,
+                                          now + self.coalesce_window)
+                self.coalescing[room_id] = message
+            else:
+                message = OutboundMessage(room_id, content, priority, now)
+            if self.outbox:
+                self.outbox.add(message.txn_id, room_id, message.content,
+                                priority)
+            self._append(message)
+        return message.future
+
+    def replay(self):
+        '''Queues the messages of the outbox not sent before a restart'''
+        if not self.outbox:
+            return 0
+        pending = []
+        now = time.time()
+        for txn_id, room_id, content, priority, created in self.outbox.get_pending():
+            if now - created > self.max_age:
+                self.logger.info("Discarding outbound message %s to %s: too old" % (
+                    txn_id, room_id))
+                self.outbox.set_state(txn_id, "failed")
+                continue
+            pending.append(OutboundMessage(room_id, content, priority, now,
+                                           txn_id, created))
+        with self.condition:
+            for message in pending:
+                self._append(message)
+        if pending:
+            self.logger.info("Replaying %s pending outbound messages" % len(pending))
+        return len(pending)
+
+    def _append(self, message):
+        '''Must be called with the condition acquired'''
+        self.lanes[message.priority].append(message)
+        self.stats["queued"] += 1
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run,
+                                           name="matrixbot-outbound",
+                                           daemon=True)
+            self.thread.start()
+        self.condition.notify()
+
+    def _pop(self, now):
+        '''Returns the next message to send or the seconds to wait for it'''
+        wait = self.bucket.get_wait(now)
+        if wait:
+            return None, wait
+        for priority in PRIORITIES:
+            lane = self.lanes[priority]
+            waiting_rooms = set()  # the order within a room is kept
+            for message in lane:
+                if message.room_id in waiting_rooms:
+                    continue
+                if message.ready_at > now:
+                    waiting_rooms.add(message.room_id)
+                    wait = min(wait or message.ready_at - now,
+                               message.ready_at - now)
+                    continue
+                room_wait = self._get_room_bucket(message.room_id).get_wait(now)
+                if room_wait:
+                    wait = min(wait or room_wait, room_wait)
+                    continue
+                lane.remove(message)
+                if self.coalescing.get(message.room_id) is message:
+                    del self.coalescing[message.room_id]
+                self.bucket.take(now)
+                self._get_room_bucket(message.room_id).take(now)
+                return message, 0
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while True:
+                    message, wait = self._pop(time.time())
+                    if message:
+                        break
+                    if self.stopped and not self.get_queue_depth():
+                        return
+                    self.condition.wait(wait or None)
+                self.sending += 1
+            try:
+                message.future.set_result(
+                    self.send(message.room_id, message.content,
+                              message.txn_id))
+                self._set_state(message, "done")
+            except Exception as e:
+                self.logger.error("Error sending message to %s: %s" % (
+                    message.room_id, e))
+                with self.condition:
+                    if is_retryable(e) and self._requeue(message):
+                        self.sending -= 1
+                        self.condition.notify_all()
+                        continue
+                # The messages not sent because we are closing stay pending
+                # in the outbox and they are sent again after a restart
+                if not is_retryable(e) or not self.closing:
+                    self._set_state(message, "failed")
+                message.future.set_exception(e)
+            with self.condition:
+                self.sending -= 1
+                self._update_stats(message)
+                self.condition.notify_all()
+
+    def _requeue(self, message):
+        '''Queues again the message (with the condition acquired) to be sent
+after the backoff. Returns False if it must not be retried'''
+        now = time.time()
+        delay = min(self.retry_max_delay,
+                    self.retry_base_delay * (2 ** message.attempts))
+        if self.closing or now + delay - message.created > self.max_age:
+            return False
+        message.attempts += 1
+        message.ready_at = now + delay
+        # Ahead of the next messages of the room, which wait for it
+        self.lanes[message.priority].appendleft(message)
+        self.stats["requeued"] += 1
+        self.logger.info("Retrying message %s to %s in %.0fs" % (
+            message.txn_id, message.room_id, delay))
+        return True
+
+    def _set_state(self, message, state):
+        if not self.outbox:
+            return
+        try:
+            self.outbox.set_state(message.txn_id, state)
+        except sqlite3.Error as e:
+            self.logger.error("Error updating the outbox: %s" % e)
+
+    def _update_stats(self, message):
+        latency = time.time() - message.created
+        self.stats["queued"] -= 1
+        if message.future.exception():
+            self.stats["failures"] += 1
+        else:
+            self.stats["sent"] += 1
+        self.stats["latency"] = latency
+        self.stats["max_latency"] = max(self.stats["max_latency"], latency)
+
+    def get_queue_depth(self):
+        return sum(len(lane) for lane in list(self.lanes.values()))
+
+    def get_stats(self):
+        with self.condition:
+            res = dict(self.stats)
+            res["rooms"] = dict(collections.Counter(
+                m.room_id for lane in self.lanes.values() for m in lane))
+            return res
+
+    def flush(self, timeout=None):
+        '''Blocks until all the queued messages are sent. The coalescing
+window of the pending messages is skipped. Returns False on timeout'''
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.condition:
+            for lane in self.lanes.values():
+                for message in lane:
+                    message.ready_at = min(message.ready_at, time.time())
+            self.coalescing.clear()
+            self.condition.notify_all()
+            while self.get_queue_depth() or self.sending:
+                wait = None
+                if deadline is not None:
+                    wait = deadline - time.time()
+                    if wait <= 0:
+                        return False
+                self.condition.wait(wait)
+        return True
+
+    def close(self, timeout=None):
+        '''Sends the pending messages (without new retries for the ones
+failing) and stops the sender thread'''
+        with self.condition:
+            self.closing = True
+        res = self.flush(timeout)
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.outbox:
+            self.outbox.close()
+        return res
+
+
+def selftest():
+    print("selftest: " + os.path.basename(__file__))
+    test_pop_order()
+    test_coalescing()
+    test_retry_order()
+
+
+def test_pop_order():
+    print("test_pop_order: ", end="")
+    q = OutboundQueue(None, rate=100, burst=100, room_rate=100,
+                      room_burst=100)
+    now = time.time()
+    a1 = OutboundMessage("!a", {"body": "a1"}, PRIORITY_NORMAL, now + 10)
+    a2 = OutboundMessage("!a", {"body": "a2"}, PRIORITY_NORMAL, now)
+    b1 = OutboundMessage("!b", {"body": "b1"}, PRIORITY_NORMAL, now)
+    c1 = OutboundMessage("!c", {"body": "c1"}, PRIORITY_HIGH, now)
+    q.lanes[PRIORITY_NORMAL].extend([a1, a2, b1])
+    q.lanes[PRIORITY_HIGH].append(c1)
+    assert(q._pop(now)[0] is c1)
+    # a2 waits for a1, which is backing off, but b1 does not
+    assert(q._pop(now)[0] is b1)
+    message, wait = q._pop(now)
+    assert(message is None and 9 < wait <= 10)
+    assert(q._pop(now + 10)[0] is a1)
+    assert(q._pop(now + 10)[0] is a2)
+    print("Ok")
+
+
+def test_coalescing():
+    print("test_coalescing: ", end="")
+    sent = []
+
+    def send(room_id, content, txn_id):
+        sent.append((room_id, content["body"]))
+        return {"event_id": txn_id}
+    q = OutboundQueue(send, rate=100, burst=100, room_rate=100,
+                      room_burst=100, coalesce_window=60, max_coalesce=3)
+    futures = [q.put("!a", {"msgtype": "m.notice", "body": str(i)},
+                     PRIORITY_LOW) for i in range(5)]
+    futures.append(q.put("!b", {"msgtype": "m.notice", "body": "b"},
+                         PRIORITY_LOW))
+    assert(len(set(futures)) == 3)
+    assert(q.close(10))
+    assert(sorted(sent) == [("!a", "0\n1\n2"), ("!a", "3\n4"), ("!b", "b")])
+    assert(q.get_stats()["merged"] == 3)
+    print("Ok")
+
+
+def test_retry_order():
+    print("test_retry_order: ", end="")
+    from matrix_client.api import MatrixRequestError
+    sent = []
+    failed = []
+
+    def send(room_id, content, txn_id):
+        if content["body"] == "a1" and not failed:
+            failed.append(txn_id)
+            raise MatrixRequestError(code=503, content="")
+        sent.append((content["body"], txn_id))
+        return {"event_id": txn_id}
+    q = OutboundQueue(send, rate=100, burst=100, room_rate=100,
+                      room_burst=100, retry_base_delay=0.1)
+    for body in ("a1", "a2"):
+        q.put("!a", {"msgtype": "m.text", "body": body})
+    q.put("!b", {"msgtype": "m.text", "body": "b1"})
+    assert(q.flush(10))
+    q.close()
+    assert([body for body, _ in sent] == ["b1", "a1", "a2"])
+    # The transaction ID is kept across the retries
+    assert(sent[1][1] == failed[0])
+    assert(q.get_stats()["requeued"] == 1)
+    print("Ok")
+
+
+if __name__ == '__main__':
+    selftest()
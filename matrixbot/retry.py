@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+from matrix_client.api import MatrixRequestError
+from matrix_client.errors import MatrixHttpLibError
+
+import asyncio
+import json
+import random
+import threading
+import time
+
+from . import utils
+
+RETRYABLE_CODES = (408, 429, 500, 502, 503, 504)
+
+
+def get_retry_after(e):
+    '''Returns the retry_after_ms (in seconds) of a M_LIMIT_EXCEEDED error'''
+    try:
+        content = json.loads(e.content)
+        if "retry_after_ms" not in content and "error" in content:
+            # Some homeservers send it JSON encoded in the error
+            content = json.loads(content["error"])
+        return content.get("retry_after_ms", 0) / 1000.0
+    except (ValueError, TypeError, AttributeError):
+        return 0
+
+
+def raise_rate_limits(api):
+    '''MatrixHttpApi._send (matrix_client 0.4.0) sleeps and retries the
+429 responses by itself, without limit, so the rate limits never reach the
+RetryPolicy. This makes the requests of the api raise a MatrixRequestError
+with the 429 response instead'''
+    request = api.session.request
+
+    def _request(*args, **kwargs):
+        response = request(*args, **kwargs)
+        if response.status_code == 429:
+            raise MatrixRequestError(code=response.status_code,
+                                     content=response.text)
+        return response
+    api.session.request = _request
+
+
+def is_retryable(e):
+    if isinstance(e, MatrixHttpLibError):
+        return True  # connection errors, timeouts, ...
+    if isinstance(e, MatrixRequestError):
+        return e.code in RETRYABLE_CODES
+    return False
+
+
+class CallStats():
+    '''Calls, retries, failures and latencies of each call site (action)'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def add(self, name, latency, retries, failed):
+        with self.lock:
+            s = self.stats.setdefault(name, {
+                "calls": 0,
+                "retries": 0,
+                "failures": 0,
+                "latency": 0,
+                "max_latency": 0,
+                "total_latency": 0,
+            })
+            s["calls"] += 1
+            s["retries"] += retries
+            s["failures"] += 1 if failed else 0
+            s["latency"] = latency
+            s["max_latency"] = max(s["max_latency"], latency)
+            s["total_latency"] += latency
+
+    def get(self):
+        with self.lock:
+            return dict((k, dict(v)) for k, v in list(self.stats.items()))
+
+
+class RetryPolicy():
+    '''Retries the calls failing with transient errors (connection errors,
+5xx, 408 and 429) with a jittered exponential backoff. The retry_after_ms of
+the rate-limited (M_LIMIT_EXCEEDED) responses is honoured and the permanent
+errors (any other 4xx) are never retried. The whole call, retries included,
+is capped to max_total_time seconds.
+    '''
+    def __init__(self, base_delay=1, max_delay=30, max_total_time=120):
+        self.logger = utils.get_logger()
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_total_time = max_total_time
+        self.stats = CallStats()
+
+    def get_delay(self, attempt, e):
+        backoff = min(self.max_delay, self.base_delay * (2 ** attempt))
+        delay = random.uniform(backoff / 2.0, backoff)
+        return max(delay, get_retry_after(e))
+
+    def _next_delay(self, name, attempt, max_attempts, started, e):
+        '''Returns the seconds to wait before the next attempt or None if the
+call must not be retried'''
+        if not is_retryable(e):
+            self.logger.debug("Permanent error in %s: %s" % (name, e))
+            return None
+        if attempt + 1 >= max_attempts:
+            return None
+        delay = self.get_delay(attempt, e)
+        if time.time() - started + delay > self.max_total_time:
+            self.logger.debug("No time left to retry %s" % name)
+            return None
+        self.logger.debug("Fail (%s/%s) in call %s: %s. Retrying in %.2fs" % (
+            attempt + 1, max_attempts, name, e, delay))
+        return delay
+
+    def call(self, name, func, max_attempts, *args):
+        '''Blocking version. Only for code running out of the asyncio loop'''
+        started = time.time()
+        attempt = 0
+        try:
+            while True:
+                try:
+                    res = func(*args)
+                    self.stats.add(name, time.time() - started, attempt, False)
+                    return res
+                except (MatrixRequestError, MatrixHttpLibError) as e:
+                    delay = self._next_delay(name, attempt, max_attempts,
+                                             started, e)
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    time.sleep(delay)
+        except Exception:
+            self.stats.add(name, time.time() - started, attempt, True)
+            raise
+
+    async def acall(self, name, func, max_attempts, *args, executor=None):
+        '''Same as call() but the attempts run in the executor and the
+backoff is awaited'''
+        loop = asyncio.get_running_loop()
+        started = time.time()
+        attempt = 0
+        try:
+            while True:
+                try:
+                    res = await loop.run_in_executor(executor, func, *args)
+                    self.stats.add(name, time.time() - started, attempt, False)
+                    return res
+                except (MatrixRequestError, MatrixHttpLibError) as e:
+                    delay = self._next_delay(name, attempt, max_attempts,
+                                             started, e)
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    await asyncio.sleep(delay)
+        except Exception:
+            self.stats.add(name, time.time() - started, attempt, True)
+            raise
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+import collections
+import os
+import threading
+import time
+
+from . import utils
+
+USER = "user"
+GROUP = "group"
+
+
+class Expression():
+    '''Compiled user selection expression:
+
+    (@user|+group) ... [but (@user|+group) ...]
+
+The users and the members of the groups before "but" are selected and the
+ones after it are excluded.
+    '''
+    def __init__(self, include, exclude):
+        self.include = include  # [(USER|GROUP, name)] in order, no dups
+        self.exclude = exclude
+        self.key = " ".join(
+            [self._term_str(t) for t in include] +
+            ["but"] +
+            sorted(self._term_str(t) for t in exclude))
+
+    @staticmethod
+    def _term_str(term):
+        kind, name = term
+        return "+%s" % name if kind == GROUP else name
+
+    def get_groups(self):
+        return set(name for kind, name in self.include + self.exclude
+                   if kind == GROUP)
+
+    def evaluate(self, get_members):
+        '''Returns the list of selected users in order of appearance.
+get_members(group) returns the normalized members of the group'''
+        excluded = set()
+        for kind, name in self.exclude:
+            if kind == GROUP:
+                excluded.update(get_members(name))
+            else:
+                excluded.add(name)
+        selected = collections.OrderedDict()
+        for kind, name in self.include:
+            users = get_members(name) if kind == GROUP else (name,)
+            for user_id in users:
+                if user_id not in excluded:
+                    selected[user_id] = True
+        return list(selected.keys())
+
+    def matches(self, user_id, user_groups):
+        '''True if the user is selected. user_groups are the groups of the
+user. The "but" part is only checked for the included users'''
+        def _match(term):
+            kind, name = term
+            return name in user_groups if kind == GROUP else name == user_id
+        if not any(_match(t) for t in self.include):
+            return False
+        return not any(_match(t) for t in self.exclude)
+
+
+def compile_expression(tokens, normalize):
+    include = []
+    exclude = []
+    terms = include
+    for token in tokens:
+        if token == "but":
+            terms = exclude
+            continue
+        if token.startswith("+"):
+            term = (GROUP, token[1:])
+        else:
+            term = (USER, normalize(token))
+        if term not in terms:
+            terms.append(term)
+    return Expression(include, exclude)
+
+
+class SelectionEngine():
+    '''Compiles the user selection expressions and evaluates them with hash
+sets. The groups are resolved at most once per evaluation and the results
+are cached per normalized expression for ttl seconds (up to max_size
+expressions).
+
+is_selected() answers if one user is selected without expanding the groups,
+with a reverse index (user -> groups) built once per groups snapshot.
+
+get_groups_members() returns a dict with the (not normalized) members of
+each group.
+    '''
+    def __init__(self, get_groups_members, normalize, ttl=60, max_size=256):
+        self.logger = utils.get_logger()
+        self.get_groups_members = get_groups_members
+        self.normalize = normalize
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.expressions = collections.OrderedDict()  # str -> Expression
+        self.results = collections.OrderedDict()  # key -> (time, users)
+        self.user_groups = None  # (groups_members, {user_id: set(groups)})
+
+    def _cache_put(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.max_size:
+            cache.popitem(last=False)
+
+    def compile(self, tokens):
+        text = " ".join(tokens)
+        with self.lock:
+            expression = self.expressions.get(text)
+            if expression is not None:
+                self.expressions.move_to_end(text)
+                return expression
+        expression = compile_expression(tokens, self.normalize)
+        with self.lock:
+            self._cache_put(self.expressions, text, expression)
+        return expression
+
+    def _get_members_resolver(self, expression):
+        '''Returns a get_members(group) function that resolves the groups
+of the expression once'''
+        groups_members = {}
+        if expression.get_groups():
+            groups_members = self.get_groups_members()
+        normalized = {}
+
+        def get_members(group):
+            if group not in normalized:
+                normalized[group] = [
+                    self.normalize(x) for x in groups_members.get(group, [])]
+            return normalized[group]
+        return get_members
+
+    def select(self, tokens):
+        '''Returns the list of users selected by the expression'''
+        expression = self.compile(tokens)
+        now = time.time()
+        with self.lock:
+            cached = self.results.get(expression.key)
+            if cached and now - cached[0] < self.ttl:
+                return list(cached[1])
+        users = expression.evaluate(self._get_members_resolver(expression))
+        with self.lock:
+            self._cache_put(self.results, expression.key, (now, users))
+        return list(users)
+
+    def _get_user_groups(self, user_id):
+        groups_members = self.get_groups_members()
+        with self.lock:
+            index = self.user_groups
+        if index is None or index[0] is not groups_members:
+            users = {}
+            for group, members in list(groups_members.items()):
+                for member in members:
+                    users.setdefault(self.normalize(member), set()).add(group)
+            index = (groups_members, users)
+            with self.lock:
+                self.user_groups = index
+        return index[1].get(user_id, set())
+
+    def is_selected(self, tokens, user_id):
+        expression = self.compile(tokens)
+        user_id = self.normalize(user_id)
+        user_groups = set()
+        if expression.get_groups():
+            user_groups = self._get_user_groups(user_id)
+        return expression.matches(user_id, user_groups)
+
+    def invalidate(self):
+        with self.lock:
+            self.results.clear()
+            self.user_groups = None
+
+
+def selftest():
+    print("selftest: " + os.path.basename(__file__))
+    test_select()
+    test_is_selected()
+
+
+def _get_test_engine(reads):
+    groups = {"g1": ["a", "b", "c"], "g2": ["c", "d"]}
+
+    def get_groups_members():
+        reads.append(1)
+        return groups
+    return SelectionEngine(get_groups_members, lambda u: u.lstrip("@"))
+
+
+def test_select():
+    print("test_select: ", end="")
+    reads = []
+    engine = _get_test_engine(reads)
+    assert(engine.select("+g1 @e but +g2 @a".split()) == ["b", "e"])
+    assert(engine.select("+g2 +g1".split()) == ["c", "d", "a", "b"])
+    assert(engine.select("@a @a".split()) == ["a"])
+    assert(engine.select(["but", "@a"]) == [])
+    assert(engine.compile("+g1 but +g2".split()).get_groups() == {"g1", "g2"})
+    assert(not engine.compile(["@a"]).get_groups())
+    # The groups are only read by the expressions using them, once per
+    # evaluation, and the results are cached
+    assert(len(reads) == 2)
+    engine.select("+g1 @e but +g2 @a".split())
+    assert(len(reads) == 2)
+    engine.invalidate()
+    engine.select("+g1 @e but +g2 @a".split())
+    assert(len(reads) == 3)
+    print("Ok")
+
+
+def test_is_selected():
+    print("test_is_selected: ", end="")
+    engine = _get_test_engine([])
+    tokens = "+g1 @e but +g2 @a".split()
+    for user_id in ("a", "b", "c", "d", "e", "f"):
+        assert(engine.is_selected(tokens, "@" + user_id) ==
+               (user_id in engine.select(tokens)))
+    print("Ok")
+
+
+if __name__ == '__main__':
+    selftest()
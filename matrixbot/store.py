@@ -0,0 +1,714 @@
+#!/usr/bin/env python3
+
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+import array
+import json
+import os
+import struct
+import sys
+import threading
+
+from . import utils
+
+ACTIVE_MEMBERSHIPS = ("join", "invite")
+MEMBERSHIPS = ("join", "invite", "leave", "ban", "knock")
+MEMBERSHIP_CODES = dict((m, i) for i, m in enumerate(MEMBERSHIPS))
+
+
+class MembershipRecord():
+    '''Compact membership of a room: the (interned) user ids and, packed in
+an array, the membership of each one as an index of MEMBERSHIPS. It is what
+we keep from a /members response instead of the whole member events.
+
+dumps/loads use a versioned binary format:
+
+    version (1 byte) | users count (4 bytes) | memberships (1 byte per user)
+    | user ids (utf-8, separated by new lines)
+    '''
+    VERSION = 1
+    HEADER = struct.Struct("!BI")
+
+    def __init__(self, user_ids=(), memberships=b""):
+        self.user_ids = tuple(sys.intern(u) for u in user_ids)
+        self.memberships = array.array("B", memberships)
+        self.positions = None
+
+    @classmethod
+    def from_events(cls, events):
+        members = {}
+        for e in events:
+            if e.get('type') == 'm.room.member' and 'state_key' in e:
+                membership = e.get('content', {}).get('membership')
+                members[e['state_key']] = MEMBERSHIP_CODES.get(
+                    membership, MEMBERSHIP_CODES["leave"])
+        return cls(list(members.keys()), list(members.values()))
+
+    def dumps(self):
+        return self.HEADER.pack(self.VERSION, len(self.user_ids)) + \
+            self.memberships.tobytes() + \
+            "\n".join(self.user_ids).encode("utf-8")
+
+    @classmethod
+    def loads(cls, data):
+        '''Raises ValueError if the data is not a valid record of this
+version'''
+        try:
+            version, count = cls.HEADER.unpack_from(data)
+        except (struct.error, TypeError) as e:
+            raise ValueError("Invalid membership record: %s" % e)
+        if version != cls.VERSION:
+            raise ValueError("Membership record version %s not supported" % version)
+        offset = cls.HEADER.size
+        memberships = data[offset:offset + count]
+        user_ids = data[offset + count:].decode("utf-8").split("\n") \
+            if count else []
+        if len(memberships) != count or len(user_ids) != count:
+            raise ValueError("Truncated membership record")
+        return cls(user_ids, memberships)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def get_membership(self, user_id):
+        if self.positions is None:
+            self.positions = dict((u, i) for i, u in enumerate(self.user_ids))
+        i = self.positions.get(user_id)
+        return MEMBERSHIPS[self.memberships[i]] if i is not None else None
+
+    def is_joined(self, user_id):
+        return self.get_membership(user_id) == "join"
+
+    def get_members(self, memberships=ACTIVE_MEMBERSHIPS):
+        codes = set(MEMBERSHIP_CODES[m] for m in memberships)
+        return set(u for u, c in zip(self.user_ids, self.memberships)
+                   if c in codes)
+
+    def count(self):
+        '''Number of joined plus invited members of the room'''
+        codes = set(MEMBERSHIP_CODES[m] for m in ACTIVE_MEMBERSHIPS)
+        return sum(1 for c in self.memberships if c in codes)
+
+    def is_private_room(self, user1_id, user2_id=None):
+        '''Same as MembershipIndex.is_private_room'''
+        if self.count() != 2:
+            return False
+        if not self.is_joined(user1_id):
+            return False
+        if user2_id is None:
+            return True
+        return self.get_membership(user2_id) in ACTIVE_MEMBERSHIPS
+
+
+class RoomMembersView():
+    '''The MembershipRecord queries over one room of a MembershipIndex'''
+    def __init__(self, index, room_id):
+        self.index = index
+        self.room_id = room_id
+
+    def get_membership(self, user_id):
+        return self.index.get_membership(self.room_id, user_id)
+
+    def is_joined(self, user_id):
+        return self.index.is_joined(self.room_id, user_id)
+
+    def get_members(self, memberships=ACTIVE_MEMBERSHIPS):
+        return self.index.get_members(self.room_id, memberships)
+
+    def count(self):
+        return self.index.count(self.room_id)
+
+    def is_private_room(self, user1_id, user2_id=None):
+        return self.index.is_private_room(self.room_id, user1_id, user2_id)
+
+
+class MembershipIndex():
+    '''Membership of every known room plus the reverse index from users to
+the rooms they are in (joined or invited). It is kept up to date with the
+m.room.member events of the sync responses so membership questions are
+answered without asking the homeserver.
+    '''
+    def __init__(self):
+        self.rooms = {}  # room_id -> {user_id: membership}
+        self.counts = {}  # room_id -> {"join": n, "invite": n}
+        self.user_rooms = {}  # user_id -> set(room_id)
+        # With lazy loaded members only the members relevant for the timeline
+        # are known, so the counters come from the sync room summary and the
+        # whole list of members is only loaded when it is needed
+        self.summaries = {}  # room_id -> {"join": n, "invite": n, "heroes": []}
+        self.complete = set()  # rooms where every member is known
+
+    def set_membership(self, room_id, user_id, membership):
+        members = self.rooms.setdefault(room_id, {})
+        counts = self.counts.setdefault(room_id, {"join": 0, "invite": 0})
+        old = members.get(user_id)
+        if old == membership:
+            return
+        if old in counts:
+            counts[old] -= 1
+        if membership in counts:
+            counts[membership] += 1
+        members[user_id] = membership
+        if membership in ACTIVE_MEMBERSHIPS:
+            self.user_rooms.setdefault(user_id, set()).add(room_id)
+        elif user_id in self.user_rooms:
+            self.user_rooms[user_id].discard(room_id)
+            if not self.user_rooms[user_id]:
+                del self.user_rooms[user_id]
+
+    def remove_room(self, room_id):
+        for user_id in self.rooms.pop(room_id, {}):
+            if user_id in self.user_rooms:
+                self.user_rooms[user_id].discard(room_id)
+                if not self.user_rooms[user_id]:
+                    del self.user_rooms[user_id]
+        self.counts.pop(room_id, None)
+        self.summaries.pop(room_id, None)
+        self.complete.discard(room_id)
+
+    def set_summary(self, room_id, summary):
+        res = self.summaries.setdefault(room_id, {})
+        if "m.joined_member_count" in summary:
+            res["join"] = summary["m.joined_member_count"]
+        if "m.invited_member_count" in summary:
+            res["invite"] = summary["m.invited_member_count"]
+        if "m.heroes" in summary:
+            res["heroes"] = summary["m.heroes"]
+
+    def get_heroes(self, room_id):
+        return self.summaries.get(room_id, {}).get("heroes", [])
+
+    def set_complete(self, room_id, complete=True):
+        if complete:
+            self.complete.add(room_id)
+        else:
+            self.complete.discard(room_id)
+
+    def is_complete(self, room_id):
+        return room_id in self.complete
+
+    def has_room(self, room_id):
+        return room_id in self.rooms
+
+    def get_membership(self, room_id, user_id):
+        return self.rooms.get(room_id, {}).get(user_id)
+
+    def is_joined(self, room_id, user_id):
+        return self.get_membership(room_id, user_id) == "join"
+
+    def count(self, room_id):
+        '''Number of joined plus invited members of the room'''
+        counts = dict(self.counts.get(room_id, {}))
+        counts.update(self.summaries.get(room_id, {}))
+        return counts.get("join", 0) + counts.get("invite", 0)
+
+    def get_members(self, room_id, memberships=ACTIVE_MEMBERSHIPS):
+        return set(
+            user_id for user_id, membership in
+            list(self.rooms.get(room_id, {}).items())
+            if membership in memberships
+        )
+
+    def get_user_rooms(self, user_id):
+        return set(self.user_rooms.get(user_id, set()))
+
+    def get_room(self, room_id):
+        return RoomMembersView(self, room_id)
+
+    def is_private_room(self, room_id, user1_id, user2_id=None):
+        '''True if the room is a 1-to-1 room where user1_id is joined and,
+if passed, user2_id is joined or invited
+        '''
+        if self.count(room_id) != 2:
+            return False
+        if not self.is_joined(room_id, user1_id):
+            return False
+        if user2_id is None:
+            return True
+        return self.get_membership(room_id, user2_id) in ACTIVE_MEMBERSHIPS
+
+
+class DirectRoomIndex():
+    '''Index from user_id to the 1-to-1 (direct) room the bot shares with
+that user. It is seeded from the m.direct account data and from the
+membership of the rooms, so looking for a PM room is a dict lookup.
+    '''
+    def __init__(self, user_id, members):
+        self.user_id = user_id
+        self.members = members
+        self.direct = {}  # m.direct account data content
+        self.user_room = {}  # user_id -> room_id
+        self.room_user = {}  # room_id -> user_id
+
+    def set_direct_account_data(self, content):
+        self.direct = content
+        for user_id, room_ids in list(content.items()):
+            for room_id in room_ids:
+                if self.members.is_private_room(room_id, self.user_id, user_id):
+                    self.set_direct_room(user_id, room_id)
+
+    def set_direct_room(self, user_id, room_id):
+        old_room_id = self.user_room.get(user_id)
+        if old_room_id and old_room_id != room_id:
+            self.room_user.pop(old_room_id, None)
+        self.user_room[user_id] = room_id
+        self.room_user[room_id] = user_id
+
+    def remove_room(self, room_id):
+        user_id = self.room_user.pop(room_id, None)
+        if user_id and self.user_room.get(user_id) == room_id:
+            del self.user_room[user_id]
+
+    def update_room(self, room_id):
+        '''Checks again if the room is a 1-to-1 room after a change in its
+membership
+        '''
+        if not self.members.is_private_room(room_id, self.user_id):
+            self.remove_room(room_id)
+            return
+        others = self.members.get_members(room_id)
+        others.discard(self.user_id)
+        if not others:
+            others = set(self.members.get_heroes(room_id))
+        for user_id in others:
+            current = self.user_room.get(user_id)
+            if current is None or current == room_id or \
+                    not self.members.is_private_room(current, self.user_id,
+                                                     user_id):
+                self.set_direct_room(user_id, room_id)
+
+    def is_direct_room(self, room_id):
+        return room_id in self.room_user
+
+    def get_direct_room(self, user_id):
+        room_id = self.user_room.get(user_id)
+        if not room_id:
+            return None
+        # Just created rooms are not in the membership index until the next
+        # sync, so they are trusted until then
+        if not self.members.has_room(room_id):
+            return room_id
+        if self.members.is_private_room(room_id, self.user_id, user_id):
+            return room_id
+        return None
+
+    def get_direct_account_data(self, user_id=None, room_id=None):
+        '''Returns (a copy of) the m.direct content, adding the
+user_id/room_id pair if passed. The pair is kept in our copy of the content
+too, so the rooms created before the next sync are not overwritten by each
+other
+        '''
+        if user_id and room_id and room_id not in self.direct.get(user_id, []):
+            self.direct = dict(self.direct)
+            self.direct[user_id] = list(self.direct.get(user_id, [])) + [room_id]
+        return dict((k, list(v)) for k, v in list(self.direct.items()))
+
+
+class RoomStateStore():
+    '''In-memory copy of the state of the rooms the bot is in.
+
+The store is fed with the sync responses: the first (initial) sync carries
+the full state of every room and the following incremental syncs only the
+state deltas (in the state section and in the timeline), which are merged on
+top of what we already have.
+    '''
+    def __init__(self, user_id):
+        self.logger = utils.get_logger()
+        self.user_id = user_id
+        # room_id -> {"membership": "join"|"invite",
+        #             "state": {event_type: {state_key: event}}}
+        self.rooms = {}
+        self.members = MembershipIndex()
+        self.direct_rooms = DirectRoomIndex(user_id, self.members)
+        self.dirty = False  # changed since the last snapshot
+        self.dirty_rooms = set()  # rooms changed since the last snapshot
+        self.lazy_load_members = False
+        # Called as callback(room_id, event) with the m.room.canonical_alias
+        # events (with the store lock acquired)
+        self.on_canonical_alias = []
+        # The store is updated from the loop but the members of a room can
+        # be loaded on demand from the workers
+        self.lock = threading.RLock()
+
+    def update(self, response):
+        with self.lock:
+            self._update(response)
+
+    def _set_dirty(self, room_id=None):
+        self.dirty = True
+        if room_id:
+            self.dirty_rooms.add(room_id)
+
+    def _update(self, response):
+        rooms = response.get("rooms", {})
+        for room_id, room in list(rooms.get("join", {}).items()):
+            self._set_membership(room_id, "join")
+            if "summary" in room:
+                self._set_summary(room_id, room["summary"])
+            # "state" holds the state previous to the timeline and the
+            # timeline may carry state changes too. Order matters.
+            self._apply_state_events(
+                room_id, room.get("state", {}).get("events", []))
+            self._apply_state_events(
+                room_id, room.get("timeline", {}).get("events", []))
+            if not self.lazy_load_members:
+                self._set_members_complete(room_id, True)
+            elif room.get("timeline", {}).get("limited"):
+                # Membership changes in the gap are not sent to us
+                self._set_members_complete(room_id, False)
+        for room_id, room in list(rooms.get("invite", {}).items()):
+            self._set_membership(room_id, "invite")
+            self._apply_state_events(
+                room_id, room.get("invite_state", {}).get("events", []))
+        for room_id in list(rooms.get("leave", {}).keys()):
+            self._remove_room(room_id)
+        for event in response.get("account_data", {}).get("events", []):
+            if event.get("type") == "m.direct":
+                self.direct_rooms.set_direct_account_data(
+                    event.get("content", {}))
+                self._set_dirty()
+
+    def _set_summary(self, room_id, summary):
+        current = self.rooms[room_id].setdefault("summary", {})
+        if any(current.get(k) != v for k, v in list(summary.items())):
+            current.update(summary)
+            self._set_dirty(room_id)
+        self.members.set_summary(room_id, summary)
+
+    def _set_members_complete(self, room_id, complete):
+        if self.rooms[room_id].get("members_complete") != complete:
+            self.rooms[room_id]["members_complete"] = complete
+            self._set_dirty(room_id)
+        self.members.set_complete(room_id, complete)
+
+    def load_members(self, room_id, events):
+        '''Loads the whole list of members of the room (the /members
+response) when only the lazy loaded members are known
+        '''
+        with self.lock:
+            if room_id not in self.rooms:
+                return
+            self._apply_state_events(room_id, events)
+            self._set_members_complete(room_id, True)
+
+    def _set_membership(self, room_id, membership):
+        room = self.rooms.get(room_id)
+        if room is None:
+            self.rooms[room_id] = {"membership": membership, "state": {}}
+            self._set_dirty(room_id)
+        elif room["membership"] != membership:
+            room["membership"] = membership
+            self._set_dirty(room_id)
+
+    def _apply_state_events(self, room_id, events):
+        state = self.rooms[room_id]["state"]
+        membership_changed = False
+        for event in events:
+            if "type" not in event or "state_key" not in event:
+                continue
+            events_by_key = state.setdefault(event["type"], {})
+            current = events_by_key.get(event["state_key"])
+            if current is not None and (
+                    current.get("event_id") == event["event_id"]
+                    if "event_id" in event else current == event):
+                continue  # Already applied
+            events_by_key[event["state_key"]] = event
+            self._set_dirty(room_id)
+            if event["type"] == "m.room.member":
+                self.members.set_membership(
+                    room_id, event["state_key"],
+                    event.get("content", {}).get("membership"))
+                membership_changed = True
+            elif event["type"] == "m.room.canonical_alias":
+                for callback in self.on_canonical_alias:
+                    callback(room_id, event)
+        if membership_changed:
+            self.direct_rooms.update_room(room_id)
+
+    def remove_room(self, room_id):
+        with self.lock:
+            self._remove_room(room_id)
+
+    def _remove_room(self, room_id):
+        self.members.remove_room(room_id)
+        self.direct_rooms.remove_room(room_id)
+        if self.rooms.pop(room_id, None) is not None:
+            self._set_dirty(room_id)
+            self.logger.debug("RoomStateStore: room %s removed" % room_id)
+
+    def get_rooms(self):
+        return list(self.rooms.keys())
+
+    def get_state_event(self, room_id, event_type, state_key=""):
+        room = self.rooms.get(room_id)
+        if not room:
+            return None
+        return room["state"].get(event_type, {}).get(state_key)
+
+    def get_canonical_alias(self, room_id):
+        event = self.get_state_event(room_id, "m.room.canonical_alias")
+        if not event:
+            return None
+        return event.get("content", {}).get("alias")
+
+    def get_room_name(self, room_id):
+        event = self.get_state_event(room_id, "m.room.name")
+        if not event:
+            return None
+        return event.get("content", {}).get("name")
+
+    def get_power_levels(self, room_id):
+        event = self.get_state_event(room_id, "m.room.power_levels")
+        if not event:
+            return {}
+        return event.get("content", {})
+
+    def has_room(self, room_id):
+        return room_id in self.rooms
+
+    def snapshot(self, full=True):
+        '''Returns the rooms changed since the previous snapshot (all the
+rooms with full) as {room_id: room or None if it was removed} and the
+m.direct content. Only the containers are copied (the events are never
+modified once stored), so it is cheap and the result can be serialized out
+of the store lock.
+        '''
+        room_ids = list(self.rooms.keys()) if full else self.dirty_rooms
+        rooms = {}
+        for room_id in room_ids:
+            room = self.rooms.get(room_id)
+            if room is not None:
+                room = dict(room)
+                room["state"] = dict((event_type, dict(events))
+                                     for event_type, events in
+                                     list(room["state"].items()))
+                if "summary" in room:
+                    room["summary"] = dict(room["summary"])
+            rooms[room_id] = room
+        self.dirty = False
+        self.dirty_rooms = set()
+        return {
+            "rooms": rooms,
+            "direct": dict(self.direct_rooms.direct),
+        }
+
+    def restore(self, snapshot):
+        with self.lock:
+            self._restore(snapshot)
+
+    def _restore(self, snapshot):
+        self.rooms = {}
+        self.members = MembershipIndex()
+        self.direct_rooms = DirectRoomIndex(self.user_id, self.members)
+        for room_id, room in list(snapshot.get("rooms", {}).items()):
+            self._set_membership(room_id, room["membership"])
+            if "summary" in room:
+                self._set_summary(room_id, room["summary"])
+            for events in list(room["state"].values()):
+                self._apply_state_events(room_id, list(events.values()))
+            if room.get("members_complete"):
+                self._set_members_complete(room_id, True)
+        self.direct_rooms.set_direct_account_data(snapshot.get("direct", {}))
+        self.dirty = False
+        self.dirty_rooms = set()
+
+
+class SyncCheckpoint():
+    '''Persists the sync token (next_batch) together with a snapshot of the
+room state store so a restart resumes with an incremental sync instead of
+a full initial one.
+
+The snapshot is only rewritten when the store changed, and only the rooms
+changed since the previous save are serialized again: the serialized rooms
+are kept in memory and the file is just their concatenation. It may be newer
+than the saved token but replaying state deltas over it is harmless.
+    '''
+    VERSION = 1
+
+    def __init__(self, path):
+        self.logger = utils.get_logger()
+        self.path = path
+        self.token_path = "%s.token" % path if path else None
+        self.rooms = {}  # room_id -> serialized room
+        self.complete = False  # self.rooms has every room of the store
+
+    def load(self):
+        if not self.path:
+            return None
+        try:
+            with open(self.token_path) as f:
+                token = json.load(f)
+            with open(self.path) as f:
+                snapshot = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            self.logger.info("No sync checkpoint loaded from %s: %s" % (self.path, e))
+            return None
+        if snapshot.get("version") != self.VERSION or \
+                token.get("version") != self.VERSION:
+            self.logger.warning("Ignoring sync checkpoint %s with a different version" % self.path)
+            return None
+        return token.get("next_batch"), snapshot
+
+    def dump(self, next_batch, store):
+        '''Takes the changes of the store to be serialized and written by
+save. It must be called from the same thread that updates the store.
+        '''
+        if not self.path:
+            return None
+        changes = None
+        if store.dirty or not self.complete:
+            with store.lock:
+                changes = store.snapshot(full=not self.complete)
+            self.complete = True
+        return next_batch, changes
+
+    def reset(self):
+        '''The next dump takes every room again (e.g. after a failed save)'''
+        self.complete = False
+
+    def save(self, dumped):
+        '''Serializes and writes the output of dump. It can run in other
+thread but the calls must not overlap'''
+        if not dumped:
+            return
+        next_batch, changes = dumped
+        if changes is not None:
+            for room_id, room in list(changes["rooms"].items()):
+                if room is None:
+                    self.rooms.pop(room_id, None)
+                else:
+                    self.rooms[room_id] = json.dumps(room)
+            content = '{"version": %s, "direct": %s, "rooms": {%s}}' % (
+                self.VERSION,
+                json.dumps(changes["direct"]),
+                ", ".join("%s: %s" % (json.dumps(room_id), room)
+                          for room_id, room in list(self.rooms.items())))
+            utils.write_file_atomically(self.path, content)
+        utils.write_file_atomically(self.token_path, json.dumps(
+            {"version": self.VERSION, "next_batch": next_batch}))
+
+
+def selftest():
+    print("selftest: " + os.path.basename(__file__))
+    test_membership_record()
+    test_membership_index()
+    test_direct_rooms()
+    test_checkpoint()
+
+
+def _member_event(user_id, membership, event_id=None):
+    return {"type": "m.room.member", "state_key": user_id,
+            "event_id": event_id or "$%s-%s" % (user_id, membership),
+            "content": {"membership": membership}}
+
+
+def test_membership_record():
+    print("test_membership_record: ", end="")
+    record = MembershipRecord.from_events([
+        _member_event("@a:x", "join"),
+        _member_event("@b:x", "invite"),
+        _member_event("@c:x", "leave"),
+        _member_event("@c:x", "join"),
+        _member_event("@d:x", "unknown"),
+    ])
+    loaded = MembershipRecord.loads(record.dumps())
+    assert(loaded.get_members() == {"@a:x", "@b:x", "@c:x"})
+    assert(loaded.get_members(("leave",)) == {"@d:x"})
+    assert(loaded.count() == 3 and len(loaded) == 4)
+    assert(loaded.get_membership("@b:x") == "invite")
+    assert(loaded.get_membership("@e:x") is None)
+    assert(MembershipRecord.loads(MembershipRecord().dumps()).count() == 0)
+    truncated = record.dumps()[:MembershipRecord.HEADER.size + 2]
+    for data in (b"", b"\x02" + record.dumps()[1:], truncated, None):
+        try:
+            MembershipRecord.loads(data)
+            assert(False)
+        except ValueError:
+            pass
+    print("Ok")
+
+
+def test_membership_index():
+    print("test_membership_index: ", end="")
+    index = MembershipIndex()
+    index.set_membership("!r", "@a", "join")
+    index.set_membership("!r", "@b", "invite")
+    index.set_membership("!r", "@b", "join")
+    index.set_membership("!r", "@c", "join")
+    index.set_membership("!r", "@c", "leave")
+    index.set_membership("!s", "@a", "join")
+    assert(index.count("!r") == 2)
+    assert(index.get_members("!r") == {"@a", "@b"})
+    assert(index.get_user_rooms("@a") == {"!r", "!s"})
+    assert(index.get_user_rooms("@c") == set())
+    assert(index.is_private_room("!r", "@a", "@b"))
+    assert(not index.is_private_room("!r", "@a", "@c"))
+    # The lazy loaded rooms are counted from the sync summary
+    index.set_summary("!s", {"m.joined_member_count": 3})
+    assert(index.count("!s") == 3)
+    index.remove_room("!r")
+    assert(index.get_user_rooms("@a") == {"!s"} and not index.has_room("!r"))
+    print("Ok")
+
+
+def test_direct_rooms():
+    print("test_direct_rooms: ", end="")
+    store = RoomStateStore("@bot")
+    store.update({
+        "rooms": {"join": {
+            "!dm": {"state": {"events": [_member_event("@bot", "join"),
+                                         _member_event("@a", "join")]}},
+            "!group": {"state": {"events": [_member_event("@bot", "join"),
+                                            _member_event("@a", "join"),
+                                            _member_event("@b", "join")]}},
+        }},
+        "account_data": {"events": [
+            {"type": "m.direct", "content": {"@a": ["!group", "!dm"]}}]},
+    })
+    assert(store.direct_rooms.get_direct_room("@a") == "!dm")
+    assert(store.direct_rooms.get_direct_room("@b") is None)
+    store.update({"rooms": {"join": {"!dm": {"timeline": {"events": [
+        _member_event("@c", "invite")]}}}}})
+    assert(store.direct_rooms.get_direct_room("@a") is None)
+    content = store.direct_rooms.get_direct_account_data("@b", "!new")
+    assert(content == {"@a": ["!group", "!dm"], "@b": ["!new"]})
+    assert(store.direct_rooms.direct["@b"] == ["!new"])
+    print("Ok")
+
+
+def test_checkpoint():
+    print("test_checkpoint: ", end="")
+    import tempfile
+    store = RoomStateStore("@bot")
+    store.update({"rooms": {"join": {
+        "!r%s" % i: {"state": {"events": [_member_event("@bot", "join")]}}
+        for i in range(3)}}})
+    with tempfile.TemporaryDirectory() as path:
+        checkpoint = SyncCheckpoint(os.path.join(path, "sync"))
+        checkpoint.save(checkpoint.dump("t1", store))
+        # Nothing changed: only the token is written
+        assert(checkpoint.dump("t2", store) == ("t2", None))
+        store.update({"rooms": {
+            "join": {"!r0": {"timeline": {"events": [
+                _member_event("@a", "join")]}}},
+            "leave": {"!r1": {}},
+        }})
+        dumped = checkpoint.dump("t3", store)
+        assert(set(dumped[1]["rooms"].keys()) == {"!r0", "!r1"})
+        checkpoint.save(dumped)
+        next_batch, snapshot = SyncCheckpoint(checkpoint.path).load()
+        restored = RoomStateStore("@bot")
+        restored.restore(snapshot)
+    assert(next_batch == "t3")
+    assert(sorted(restored.get_rooms()) == ["!r0", "!r2"])
+    assert(restored.members.get_members("!r0") == {"@bot", "@a"})
+    assert(not restored.dirty)
+    print("Ok")
+
+
+if __name__ == '__main__':
+    selftest()
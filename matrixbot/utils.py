@@ -7,14 +7,29 @@
 # Contact: saavedra.pablo at gmail.com
 
 import sys
+import os
 import logging
 import copy
+import fcntl
+import json
 import memcache
 import imp
 
 from datetime import datetime, timedelta
 from dateutil import parser
 
+from .cache import ShardedMemcache, TieredCache
+
+# Optional faster JSON decoders for the (big) sync responses
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 puts = sys.stdout.write
 
 def get_default_settings():
@@ -48,6 +63,7 @@ def get_default_settings():
         "rooms": [],
         "only_local_domain": False,
         "super_users": [],
+        "cleanup_period": 3600,
     }
     settings["ldap"] = {
         "server": "ldap://ldap.local",
@@ -67,6 +83,9 @@ def get_default_settings():
     settings["allowed-join"] = {
         "default": ""
     }
+    settings["storage"] = {
+        "path": "~/.matrix-bot",
+    }
     settings["plugins"] = {}
     settings["commands"] = {
         "enable": True,
@@ -100,9 +119,99 @@ def setup(conffile, settings):
     exec(compile(open(conffile).read(), conffile, 'exec'))
 
 
+def get_memcached_servers(settings):
+    '''Returns {"ip:port": weight} from the "servers" list of the memcached
+settings (["ip:port", ("ip:port", weight), ...]) or from its ip and port'''
+    memcached = settings["memcached"]
+    servers = memcached.get("servers")
+    if not servers:
+        return {'%(ip)s:%(port)s' % memcached: 1}
+    res = {}
+    for server in servers:
+        if isinstance(server, (list, tuple)):
+            res[server[0]] = server[1]
+        else:
+            res[server] = 1
+    return res
+
+
 def create_cache(settings):
-    cache = memcache.Client(['%(ip)s:%(port)s' % settings["memcached"]], debug=0)
-    return cache
+    memcached = settings["memcached"]
+    servers = get_memcached_servers(settings)
+    if len(servers) == 1:
+        backend = memcache.Client(list(servers.keys()), debug=0)
+    else:
+        backend = ShardedMemcache(
+            servers, lambda server: memcache.Client([server], debug=0))
+    return TieredCache(backend,
+                       max_items=memcached.get("local_max_items", 1024),
+                       local_ttl=memcached.get("local_ttl", 60),
+                       negative_ttl=memcached.get("negative_ttl", 30))
+
+
+def get_storage_file(settings, name):
+    '''Returns the path of a file in the local storage directory or None if
+the local storage is disabled (empty path)
+    '''
+    path = settings.get("storage", {}).get("path")
+    if not path:
+        return None
+    path = os.path.expanduser(path)
+    if not os.path.isdir(path):
+        os.makedirs(path, mode=0o700)
+    return os.path.join(path, name)
+
+
+def lock_file(path):
+    '''Takes an exclusive lock on path (created if needed). Returns the
+open file, which holds the lock until it is closed, or None if other process
+has the lock'''
+    f = open(path, "a")
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        f.close()
+        return None
+    return f
+
+
+def rename_database(src, dst):
+    '''Renames a SQLite database together with its -wal and -shm files.
+The database file goes last, so an interrupted rename can be done again'''
+    for suffix in ("-wal", "-shm", ""):
+        if os.path.exists(src + suffix):
+            os.rename(src + suffix, dst + suffix)
+
+
+def write_file_atomically(path, content, mode=0o600):
+    tmp_path = "%s.tmp" % path
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, "w") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def get_json_backend():
+    if orjson:
+        return "orjson"
+    if ujson:
+        return "ujson"
+    return "json"
+
+
+def json_loads(data, backend=None):
+    '''Decodes JSON (str or bytes) with the fastest backend available'''
+    backend = backend or get_json_backend()
+    if backend == "orjson":
+        return orjson.loads(data)
+    if backend == "ujson":
+        return ujson.loads(data)
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    return json.loads(data)
+
 
 def create_logger(settings):
     logfile = settings["DEFAULT"]["logfile"]
@@ -125,14 +234,6 @@ def get_logger():
     return logging.getLogger('matrixbot')
 
 
-def get_command_alias(message, settings):
-    prefix = message.strip().split()[0]
-    command = " ".join(message.strip().split()[1:])
-    if command in list(settings["aliases"].keys()):
-        return prefix + " " + settings["aliases"][command]
-    return message
-
-
 def get_aliases(settings):
     res = copy.copy(settings["aliases"])
     return res
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# -*- coding:utf-8 -*-
+#
+# Author: Pablo Saavedra
+# Maintainer: Pablo Saavedra
+# Contact: saavedra.pablo at gmail.com
+
+import asyncio
+import collections
+import concurrent.futures
+import time
+
+from . import utils
+
+
+class RoomWorkerPool():
+    '''Processes the events of the rooms in parallel across rooms but
+serially (in order) within a room. The events are processed in a pool of
+max_workers threads of its own, so slow events do not take the threads used
+for the sync and the other homeserver I/O.
+
+An event not processed after timeout seconds is reported as done (so the
+dispatch of the sync response does not wait for it) but the next event of
+the same room is not started until the thread processing it finishes.
+
+handler is a function called as handler(room_id, event).
+    '''
+    def __init__(self, handler, max_workers=10, timeout=None):
+        self.logger = utils.get_logger()
+        self.handler = handler
+        self.timeout = timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers)
+        self.queues = {}  # room_id -> deque([(event, queued_at, future)])
+        self.running = {}  # room_id -> task draining the room queue
+        self.stats = {}  # room_id -> counters
+
+    def _get_stats(self, room_id):
+        return self.stats.setdefault(room_id, {
+            "queued": 0,
+            "processed": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "latency": 0,
+            "max_latency": 0,
+        })
+
+    def submit(self, room_id, event):
+        '''Queues the event and returns a future done when it is processed
+(or when it times out)'''
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.setdefault(room_id, collections.deque())
+        queue.append((event, time.time(), future))
+        self._get_stats(room_id)["queued"] = len(queue)
+        if room_id not in self.running:
+            self.running[room_id] = asyncio.ensure_future(self._drain(room_id))
+        return future
+
+    async def _drain(self, room_id):
+        loop = asyncio.get_running_loop()
+        queue = self.queues[room_id]
+        stats = self._get_stats(room_id)
+        try:
+            while queue:
+                event, queued_at, future = queue.popleft()
+                stats["queued"] = len(queue)
+                processing = loop.run_in_executor(self.executor, self.handler,
+                                                  room_id, event)
+                try:
+                    try:
+                        # shield: the thread can not be cancelled, so on
+                        # timeout we keep waiting for it before the next event
+                        await asyncio.wait_for(asyncio.shield(processing),
+                                               self.timeout)
+                    except asyncio.TimeoutError:
+                        stats["timeouts"] += 1
+                        self.logger.warning(
+                            "Event %s in %s timed out after %ss" % (
+                                event.get("event_id"), room_id, self.timeout))
+                        if not future.done():
+                            future.set_result(None)
+                        await processing
+                except Exception as e:
+                    stats["errors"] += 1
+                    self.logger.error("Error processing event in %s: %s" % (
+                        room_id, e))
+                latency = time.time() - queued_at
+                stats["processed"] += 1
+                stats["latency"] = latency
+                stats["max_latency"] = max(stats["max_latency"], latency)
+                if not future.done():
+                    future.set_result(None)
+        finally:
+            del self.running[room_id]
+            if not queue:
+                del self.queues[room_id]
+
+    def get_stats(self):
+        return dict((room_id, dict(stats))
+                    for room_id, stats in list(self.stats.items()))
+
+    def get_queue_depth(self):
+        return sum(len(q) for q in list(self.queues.values()))
@@ -0,0 +1,36 @@
+#!/usr/bin/env bash
+
+fatal() {
+    echo "Error: $1"
+    exit 1
+}
+
+ROOT=$(git rev-parse --show-toplevel)
+
+# The core modules use relative imports, so they run as modules of the
+# matrixbot package
+MODULES=(
+	matrixbot.bulk
+	matrixbot.cache
+	matrixbot.outbound
+	matrixbot.selection
+	matrixbot.store
+)
+
+which python3 &>/dev/null
+if  [[ $? -ne 0 ]]; then
+    fatal "Python3 is required"
+fi
+
+cd $ROOT
+for each in ${MODULES[@]}; do
+    echo -n "Testing $each: "
+    content=$(python3 -m "$each" 2>&1)
+    if [[ $? -eq 0 ]]; then
+        echo "OK"
+    else
+        echo "Error"
+        echo "$content"
+        exit 1
+    fi
+done
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# -*- coding:utf-8 -*-
+#
+# Measures the decoding time per MB of sync responses with every JSON backend
+# available (json and, if they are installed, orjson and ujson).
+#
+# Usage: sync-json-benchmark.py [SYNC_RESPONSE.json]
+#
+# Without arguments a synthetic initial sync response (many rooms with their
+# full state) is used.
+
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from matrixbot import utils
+
+ROOMS = 300
+MEMBERS_PER_ROOM = 100
+MESSAGES_PER_ROOM = 20
+ITERATIONS = 5
+
+
+def member_event(room_id, user_id, i):
+    return {
+        "type": "m.room.member",
+        "state_key": user_id,
+        "sender": user_id,
+        "event_id": "$%s-member-%d" % (room_id, i),
+        "origin_server_ts": 1600000000000 + i,
+        "content": {
+            "membership": "join",
+            "displayname": "User %d" % i,
+            "avatar_url": "mxc://example.com/%d" % i,
+        },
+        "unsigned": {"age": 1234 + i},
+    }
+
+
+def message_event(room_id, user_id, i):
+    return {
+        "type": "m.room.message",
+        "sender": user_id,
+        "event_id": "$%s-message-%d" % (room_id, i),
+        "origin_server_ts": 1600000000000 + i,
+        "content": {
+            "msgtype": "m.text",
+            "body": "bot: list +group%d but @user%d ✓" % (i, i),
+        },
+        "unsigned": {"age": 1234 + i},
+    }
+
+
+def synthetic_sync_response():
+    join = {}
+    for r in range(ROOMS):
+        room_id = "!room%d:example.com" % r
+        users = ["@user%d:example.com" % i for i in range(MEMBERS_PER_ROOM)]
+        join[room_id] = {
+            "state": {"events": [member_event(room_id, u, i)
+                                 for i, u in enumerate(users)]},
+            "timeline": {"events": [message_event(room_id, users[i], i)
+                                    for i in range(MESSAGES_PER_ROOM)],
+                         "limited": True},
+            "summary": {"m.joined_member_count": MEMBERS_PER_ROOM},
+        }
+    return {"next_batch": "s1_2_3", "rooms": {"join": join}}
+
+
+def available_backends():
+    res = ["json"]
+    if utils.orjson:
+        res.append("orjson")
+    if utils.ujson:
+        res.append("ujson")
+    return res
+
+
+def benchmark(data, backend):
+    best = None
+    for _ in range(ITERATIONS):
+        started = time.perf_counter()
+        utils.json_loads(data, backend)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "rb") as f:
+            data = f.read()
+    else:
+        data = json.dumps(synthetic_sync_response()).encode("utf-8")
+    mb = len(data) / (1024.0 * 1024.0)
+    print("Sync response: %.2f MB (best of %d)" % (mb, ITERATIONS))
+    for backend in available_backends():
+        elapsed = benchmark(data, backend)
+        print("%-8s %8.2f ms/MB (%.3f s)" % (backend, elapsed * 1000 / mb,
+                                             elapsed))
+
+
+if __name__ == '__main__':
+    main()